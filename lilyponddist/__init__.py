@@ -2,19 +2,22 @@ from __future__ import annotations
 import sys
 
 from pathlib import Path
-import platform
-import sysconfig
 import os
 import re
 import logging
-import urllib.request
-import tempfile
-import appdirs
-import progressbar
-import subprocess
 import functools
+import threading
+import time
 
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from typing import Callable
+    import concurrent.futures
+    import progressbar
 
+
+# Each entry is either an url or a tuple (url, sha256), where sha256 is
+# the hex digest of the archive. When a digest is given, downloads are verified
 _urls = {
     (2, 24, 1): {
         ('windows', 'x86_64'): "https://gitlab.com/lilypond/lilypond/-/releases/v2.24.1/downloads/lilypond-2.24.1-mingw-x86_64.zip",
@@ -64,6 +67,7 @@ class _ProgressBar():
 
     def __call__(self, block_num, block_size, total_size):
         if not self.pbar:
+            import progressbar
             self.pbar = progressbar.ProgressBar(maxval=total_size)
             self.pbar.start()
 
@@ -74,12 +78,141 @@ class _ProgressBar():
             self.pbar.finish()
 
 
-def _download(url: str, destFolder: Path, showprogress=True, skip=True) -> Path:
+def _urlentry(entry: str | tuple[str, str]) -> tuple[str, str]:
+    """
+    Returns (url, sha256) for an entry in _urls. sha256 is empty if unknown
+    """
+    if isinstance(entry, tuple):
+        return entry
+    return entry, ''
+
+
+def _sha256sum(path: Path) -> str:
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(2**20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _http_head(url: str) -> tuple[int, bool]:
+    """
+    Returns (size, acceptsranges) for url. size is -1 if unknown
+    """
+    import urllib.request
+    req = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(req) as resp:
+        size = int(resp.headers.get('Content-Length', -1))
+        acceptsranges = resp.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    return size, acceptsranges
+
+
+class _DownloadProgress:
+    """
+    Thread-safe byte counter, optionally showing a progress bar
+    """
+
+    def __init__(self, totalsize: int, showprogress=True, done=0):
+        self.totalsize = totalsize
+        self.done = done
+        self.lock = threading.Lock()
+        self.pbar = _ProgressBar() if showprogress and totalsize > 0 else None
+
+    def __call__(self, numbytes: int):
+        with self.lock:
+            self.done += numbytes
+            if self.pbar:
+                self.pbar(self.done, 1, self.totalsize)
+
+
+def _fetch_range(url: str, dest: Path, start: int, end: int, progress: _DownloadProgress, retries=3) -> None:
+    """
+    Download the bytes start to end (inclusive) of url to dest
+
+    If dest already holds the first part of the range, only the rest is
+    downloaded. Interrupted transfers are resumed up to `retries` times
+    """
+    import http.client
+    import urllib.request
+    expected = end - start + 1
+    error: Exception | None = None
+    for _ in range(retries):
+        have = dest.stat().st_size if dest.exists() else 0
+        if have >= expected:
+            break
+        req = urllib.request.Request(url, headers={'Range': f'bytes={start + have}-{end}'})
+        try:
+            with urllib.request.urlopen(req) as resp, open(dest, 'ab') as f:
+                if resp.status != 206:
+                    raise OSError(f"The server did not honour the range request for {url}")
+                while chunk := resp.read(2**16):
+                    f.write(chunk)
+                    progress(len(chunk))
+        except (OSError, http.client.HTTPException) as e:
+            logger.info(f"Download of bytes {start + have}-{end} of {url} interrupted ({e}), retrying")
+            error = e
+    if (have := dest.stat().st_size if dest.exists() else 0) != expected:
+        raise OSError(f"Could not download bytes {start}-{end} of {url}, got {have} of {expected} bytes") from error
+
+
+def _fetch_ranges(url: str, dest: Path, size: int, connections: int, progress: _DownloadProgress) -> None:
+    """
+    Download url to dest using parallel range requests
+
+    Each segment is downloaded to its own part file ('<dest>.part0of4', ...).
+    Part files are kept if the download fails, so that a later call resumes them
+    """
+    import concurrent.futures
+    import shutil
+    segsize = -(-size // connections)
+    segments = []
+    for i, start in enumerate(range(0, size, segsize)):
+        part = dest.with_suffix(f".part{i}of{connections}")
+        segments.append((part, start, min(start + segsize, size) - 1))
+        if part.exists():
+            progress(part.stat().st_size)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [executor.submit(_fetch_range, url, part, start, end, progress)
+                   for part, start, end in segments]
+        for future in futures:
+            future.result()
+    with open(dest, 'wb') as f:
+        for part, _, _ in segments:
+            with open(part, 'rb') as partfile:
+                shutil.copyfileobj(partfile, f, 2**20)
+    for part, _, _ in segments:
+        part.unlink()
+
+
+def _download(url: str, destFolder: Path, showprogress=True, skip=True, sha256='', connections=4) -> Path:
+    """
+    Download url to destFolder
+
+    If the server supports range requests, the file is downloaded in
+    `connections` segments in parallel. Partial downloads are kept as
+    part files and resumed by later calls. A server which rejects HEAD
+    requests is downloaded with a single GET. The destination file only
+    appears once it is complete and, if sha256 is given, verified
+
+    Args:
+        url: the url to download
+        destFolder: the folder to download to
+        showprogress: show a progress bar
+        skip: if the destination exists already and is complete, do not download again
+        sha256: the expected hex digest of the file, or an empty string to skip verification
+        connections: max. number of parallel connections
+
+    Returns:
+        the path of the downloaded file
+    """
+    import urllib.error
+    import urllib.request
     assert destFolder.exists() and destFolder.is_dir()
     fileName = os.path.split(url)[1]
     dest = Path(destFolder) / fileName
     if dest.exists():
-        if skip:
+        if skip and _is_complete(dest, url, sha256):
             logger.info(f"Destination {dest} already exists, no need to download")
             return dest
         else:
@@ -87,50 +220,543 @@ def _download(url: str, destFolder: Path, showprogress=True, skip=True) -> Path:
             os.remove(dest)
     if showprogress:
         print(f"Downloading {url}")
-        urllib.request.urlretrieve(url, dest, _ProgressBar())
     else:
         logger.info(f"Downloading {url}")
-        urllib.request.urlretrieve(url, dest)
+    from .metrics import _emit
+    t0 = time.time()
+    try:
+        size, acceptsranges = _http_head(url)
+    except urllib.error.HTTPError as e:
+        # Some servers (presigned urls, for example) only answer GET
+        logger.debug(f"HEAD request for {url} failed ({e}), downloading with a single request")
+        size, acceptsranges = -1, False
+    partial = dest.with_name(dest.name + '.part')
+    if acceptsranges and size > 0 and connections > 1:
+        progress = _DownloadProgress(size, showprogress=showprogress)
+        _fetch_ranges(url, partial, size=size, connections=connections, progress=progress)
+    else:
+        with urllib.request.urlopen(url) as resp, open(partial, 'wb') as f:
+            if size < 0:
+                size = int(resp.headers.get('Content-Length', -1))
+            progress = _DownloadProgress(size, showprogress=showprogress)
+            while chunk := resp.read(2**16):
+                f.write(chunk)
+                progress(len(chunk))
+    if size > 0 and (partialsize := partial.stat().st_size) != size:
+        partial.unlink()
+        raise OSError(f"Download of {url} incomplete: expected {size} bytes, got {partialsize}")
+    if sha256 and (digest := _sha256sum(partial)) != sha256:
+        partial.unlink()
+        raise OSError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+    os.replace(partial, dest)
+    elapsed = time.time() - t0
+    _emit('download', elapsed, bytes=progress.done, throughput=progress.done / elapsed if elapsed > 0 else 0.)
     logger.info(f"   ... saved to {dest}")
     return dest
 
 
-def _uncompress(path: Path, destfolder: Path):
-    def _zipextract(zippedfile: Path, destfolder: Path):
-        import zipfile
-        with zipfile.ZipFile(zippedfile, 'r') as z:
-            z.extractall(destfolder)
+def _is_complete(path: Path, url: str, sha256='') -> bool:
+    """
+    Check that a previously downloaded file is complete
+
+    With a digest the file is verified. Otherwise its size is compared to
+    the size reported by the server, if the server can be reached
+    """
+    if sha256:
+        return _sha256sum(path) == sha256
+    try:
+        size, _ = _http_head(url)
+    except OSError:
+        return True
+    return size < 0 or path.stat().st_size == size
+
+
+class _ProgressReader:
+    """
+    Wraps a file object, reporting the bytes read to a urlretrieve-like callback
+
+    If a hash object is given, it is updated with the data read. The time
+    spent reading is accumulated in `readtime`
+    """
+
+    def __init__(self, fileobj, totalsize: int, callback, hashobj=None):
+        self.fileobj = fileobj
+        self.totalsize = totalsize
+        self.callback = callback
+        self.hashobj = hashobj
+        self.bytesread = 0
+        self.readtime = 0.
+
+    def read(self, size=-1) -> bytes:
+        t0 = time.time()
+        data = self.fileobj.read(size)
+        self.readtime += time.time() - t0
+        self.bytesread += len(data)
+        if self.hashobj is not None:
+            self.hashobj.update(data)
+        self.callback(self.bytesread, 1, self.totalsize)
+        return data
+
+
+def _download_and_extract(url: str, destfolder: Path, showprogress=True, sha256='', fixtimes=False,
+                          keep: Callable[[str], bool] | None = None) -> None:
+    """
+    Download a .tar.gz archive and extract it while it is being downloaded
+
+    The archive is never written to disk. Download and decompression overlap.
+    The length and, if given, the sha256 digest of the archive are verified
+    once the whole archive has been read. If fixtimes is True, the compiled
+    guile files are given the current time while extracting (see _fix_times).
+    If keep is given, only members for which keep(relpath) is True are
+    extracted (see _install_profiles)
+    """
+    import hashlib
+    import tarfile
+    import urllib.request
+    from .metrics import _emit
+    if not url.endswith('.tar.gz'):
+        raise ValueError(f"Only .tar.gz archives can be streamed, got {url}")
+    destfolder.mkdir(exist_ok=True, parents=True)
+    if showprogress:
+        print(f"Downloading and extracting {url}")
+    else:
+        logger.info(f"Downloading and extracting {url}")
+    h = hashlib.sha256()
+    t0 = time.time()
+    with urllib.request.urlopen(url) as response:
+        totalsize = int(response.headers.get('Content-Length', -1))
+        callback = _ProgressBar() if showprogress and totalsize > 0 else lambda *args: None
+        fileobj = _ProgressReader(response, totalsize, callback, h)
+        with tarfile.open(fileobj=fileobj, mode='r|gz') as tfile:
+            tfile.extractall(destfolder, members=_tar_members(tfile, fixtimes=fixtimes, keep=keep))
+        # Consume any trailing padding, so that the length and digest cover the whole file
+        while fileobj.read(2**16):
+            pass
+    if totalsize > 0 and fileobj.bytesread != totalsize:
+        raise OSError(f"Download of {url} incomplete: expected {totalsize} bytes, got {fileobj.bytesread}")
+    if sha256 and (digest := h.hexdigest()) != sha256:
+        raise OSError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+    # Download and extraction overlap: the time waiting for data is the download
+    downloadtime = fileobj.readtime
+    _emit('download', downloadtime, bytes=fileobj.bytesread,
+          throughput=fileobj.bytesread / downloadtime if downloadtime > 0 else 0.)
+    _emit('extract', time.time() - t0 - downloadtime, labels={'format': 'tar.gz'})
+    logger.info(f"   ... extracted to {destfolder}")
+
+
+def _relpath(membername: str) -> str:
+    """
+    The path of an archive member relative to the root of the installation
 
+    All members of a release archive are within a 'lilypond-<version>' folder
+    """
+    parts = membername.replace('\\', '/').split('/', 1)
+    return parts[1] if len(parts) > 1 else ''
+
+
+def _tar_members(tfile, fixtimes=False, keep: Callable[[str], bool] | None = None):
+    """
+    Iterate over the members of a tar file, filtering and fixing them
+
+    Args:
+        tfile: the tar file
+        fixtimes: set the mtime of compiled guile files to now. Setting the time
+            while extracting makes a second pass over the extracted files
+            (see _fix_times) unnecessary
+        keep: if given, only members for which keep(relpath) is True are yielded
+    """
+    now = time.time()
+    for member in tfile:
+        if keep is not None and not keep(_relpath(member.name)):
+            continue
+        if fixtimes and member.isfile() and member.name.endswith('.go') and '/ccache/' in member.name:
+            member.mtime = now
+        yield member
+
+
+def _zipdest(destfolder: str, name: str) -> str | None:
+    """
+    The destination of a zip member, sanitized as ZipFile.extract does
+
+    Returns None if the member has no valid path
+    """
+    name = name.replace('\\', '/')
+    parts = [part for part in name.split('/') if part not in ('', '.', '..')]
+    if parts and len(parts[0]) == 2 and parts[0][1] == ':':
+        # A windows drive
+        parts = parts[1:]
+    if not parts:
+        return None
+    return os.path.join(destfolder, *parts)
+
+
+def _zipextract(path: Path, destfolder: Path, keep: Callable[[str], bool] | None = None, workers=0) -> None:
+    """
+    Extract a zip archive using a thread pool
+
+    The members of a zip file are compressed independently, so they can be
+    decompressed and written in parallel (zlib releases the GIL). The
+    folder tree is created first, in one pass, and the members are
+    distributed between the threads in batches of similar compressed size.
+    Each thread reads the archive via its own handle
+
+    Args:
+        path: the .zip file
+        destfolder: where to extract to
+        keep: if given, only members for which keep(relpath) is True are extracted
+        workers: number of threads, 0 to use a default
+    """
+    import concurrent.futures
+    import heapq
+    import shutil
+    import zipfile
+    dest = str(destfolder)
+    with zipfile.ZipFile(path, 'r') as z:
+        infos = [info for info in z.infolist() if keep is None or keep(_relpath(info.filename))]
+    folders = set()
+    files = []
+    for info in infos:
+        if (target := _zipdest(dest, info.filename)) is None:
+            continue
+        if info.is_dir():
+            folders.add(target)
+        else:
+            folders.add(os.path.dirname(target))
+            files.append((info, target))
+    for folder in sorted(folders):
+        os.makedirs(folder, exist_ok=True)
+    if not files:
+        return
+
+    def extract(batch: list[tuple[zipfile.ZipInfo, str]]):
+        with zipfile.ZipFile(path, 'r') as z:
+            for info, target in batch:
+                with z.open(info) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 2**20)
+
+    if not workers:
+        workers = min(16, os.cpu_count() or 1)
+    # Largest members first, each to the batch with the least data so far
+    files.sort(key=lambda item: item[0].compress_size, reverse=True)
+    numbatches = min(workers * 4, len(files))
+    batches: list[list[tuple[zipfile.ZipInfo, str]]] = [[] for _ in range(numbatches)]
+    heap = [(0, i) for i in range(numbatches)]
+    for item in files:
+        size, i = heapq.heappop(heap)
+        batches[i].append(item)
+        heapq.heappush(heap, (size + item[0].compress_size + 4096, i))
+    if workers == 1:
+        for batch in batches:
+            extract(batch)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(extract, batch) for batch in batches]:
+            future.result()
+
+
+def _uncompress(path: Path, destfolder: Path, fixtimes=False, keep: Callable[[str], bool] | None = None) -> bool:
+    """
+    Extract a .zip or .tar.gz archive to destfolder
+
+    Args:
+        path: the archive
+        destfolder: where to extract to
+        fixtimes: if True, set the times of compiled guile files while
+            extracting, if the archive format allows it
+        keep: if given, only members for which keep(relpath) is True are extracted
+
+    Returns:
+        True if the times were fixed while extracting
+    """
     def _targzextract(f: Path, destfolder: Path):
         import tarfile
-        tfile = tarfile.open(f)
-        tfile.extractall(destfolder)
+        with tarfile.open(f) as tfile:
+            tfile.extractall(destfolder, members=_tar_members(tfile, fixtimes=fixtimes, keep=keep))
 
+    from .metrics import _emit
     destfolder.mkdir(exist_ok=True, parents=True)
-
+    t0 = time.time()
     if path.name.endswith('.zip'):
-        _zipextract(path, destfolder)
+        # zip extraction does not restore times, every file gets the time
+        # at which it was written
+        _zipextract(path, destfolder, keep=keep)
+        _emit('extract', time.time() - t0, labels={'format': 'zip'})
+        return False
     elif path.name.endswith('.tar.gz'):
         _targzextract(path, destfolder)
+        _emit('extract', time.time() - t0, labels={'format': 'tar.gz'})
+        return fixtimes
     else:
         raise RuntimeError(f"File format of {path} not supported")
 
 
+@functools.cache
 def _lilyponddist_folder() -> Path:
+    """
+    The folder holding the installations, the index and any other data
+
+    Can be set via the environment variable LILYPONDDIST_DATA, otherwise
+    the user data folder of the platform is used
+    """
+    if folder := os.environ.get('LILYPONDDIST_DATA'):
+        return Path(folder)
+    import appdirs
     return Path(appdirs.user_data_dir('lilyponddist'))
 
 
+class _FileLock:
+    """
+    An exclusive lock shared between processes, based on a lock file
+
+    Uses flock on posix and msvcrt.locking on windows. The lock is held by an
+    open file description, so it also excludes other threads of the same process
+
+    Args:
+        path: the lock file
+        timeout: max. time to wait for the lock, 0 to wait indefinitely
+        poll: time between attempts to acquire the lock
+    """
+
+    def __init__(self, path: Path, timeout=0., poll=0.2):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self._fd: int | None = None
+
+    def _trylock(self, fd: int) -> bool:
+        try:
+            if sys.platform == 'win32':
+                import msvcrt
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def acquire(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        t0 = time.time()
+        waiting = False
+        while not self._trylock(fd):
+            if not waiting:
+                logger.info(f"Waiting for lock '{self.path}', held by another process")
+                waiting = True
+            if self.timeout and time.time() - t0 > self.timeout:
+                os.close(fd)
+                raise TimeoutError(f"Could not acquire lock '{self.path}' after {self.timeout} seconds")
+            time.sleep(self.poll)
+        self._fd = fd
+
+    def release(self) -> None:
+        fd = self._fd
+        if fd is None:
+            return
+        self._fd = None
+        if sys.platform == 'win32':
+            import msvcrt
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _install_lock(versiontup: tuple[int, int, int], timeout=0.) -> _FileLock:
+    versionstr = ".".join(map(str, versiontup))
+    return _FileLock(_lilyponddist_folder() / f".install-{versionstr}.lock", timeout=timeout)
+
+
+# Parts of an installation which are not needed to render: documentation,
+# translations, the python based tools (convert-ly, lilypond-book, ...) and
+# editor support
+_renderonly_exclude = re.compile(
+    r"^share/(doc|info|man|locale|emacs)(/|$)"
+    r"|^share/lilypond/[^/]+/(python|vim|tex)(/|$)"
+    r"|^lib/python"
+    r"|^bin/(convert-ly|lilypond-book|musicxml2ly|abc2ly|midi2ly|etf2ly|lilysong|lilymidi"
+    r"|lilypond-invoke-editor|python[0-9.]*)(\.py|\.exe)?$")
+
+
+_install_profiles: dict[str, Callable[[str], bool] | None] = {
+    'full': None,
+    'render-only': lambda relpath: not _renderonly_exclude.match(relpath)
+}
+
+
+# A local folder or an url holding release archives, searched before the
+# urls in _urls. See set_mirror
+_mirror = {'location': os.environ.get('LILYPONDDIST_MIRROR', ''), 'fallback': True}
+
+
+def set_mirror(location: str | Path = '', fallback=True) -> None:
+    """
+    Install from a mirror of the release archives
+
+    A mirror is a folder (local or served via http) holding the release
+    archives under their original filename, together with a file
+    'SHA256SUMS' listing their digests (as written by the `sha256sum` tool).
+    Such a folder can be created and kept up to date with :func:`sync_mirror`.
+    The mirror can also be set via the environment variable LILYPONDDIST_MIRROR
+
+    Archives are only installed from the mirror if their digest is known,
+    either from the mirror or from the registry of this package, and they
+    are verified before being installed
+
+    Args:
+        location: a local folder or an http(s) url. An empty string
+            disables the mirror
+        fallback: if True, versions not found in the mirror are downloaded
+            from the lilypond releases. Otherwise installing such a version
+            fails, which is what air-gapped machines need
+
+    Example
+    ~~~~~~~
+
+    >>> set_mirror('/mnt/share/lilypond-mirror', fallback=False)
+    >>> lilypondbin()
+    """
+    _mirror['location'] = str(location)
+    _mirror['fallback'] = fallback
+    _mirror_checksums.cache_clear()
+
+
+def _is_url(location: str) -> bool:
+    return re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*://", location) is not None
+
+
+@functools.cache
+def _mirror_checksums(location: str) -> dict[str, str]:
+    """
+    The digests listed in the SHA256SUMS file of the mirror, as {filename: sha256}
+    """
+    try:
+        if _is_url(location):
+            import urllib.request
+            with urllib.request.urlopen(f"{location.rstrip('/')}/SHA256SUMS") as resp:
+                text = resp.read().decode()
+        else:
+            text = (Path(location) / 'SHA256SUMS').read_text()
+    except OSError as e:
+        logger.warning(f"Could not read the checksums of the mirror '{location}': {e}")
+        return {}
+    return _parse_checksums(text)
+
+
+def _parse_checksums(text: str) -> dict[str, str]:
+    """
+    Parse the output of sha256sum as {filename: sha256}
+    """
+    out = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            out[parts[1].lstrip('*')] = parts[0].lower()
+    return out
+
+
+def _mirror_source(url: str, sha256='') -> tuple[str, str] | None:
+    """
+    Resolve an archive via the mirror
+
+    Args:
+        url: the original url of the archive
+        sha256: its digest, if known
+
+    Returns:
+        a tuple (location, sha256), where location is an url or a local path,
+        or None if the archive cannot be installed from the mirror
+    """
+    location = _mirror['location']
+    name = os.path.split(url)[1]
+    if _is_url(location):
+        candidate = f"{location.rstrip('/')}/{name}"
+        try:
+            _http_head(candidate)
+        except OSError as e:
+            logger.info(f"'{name}' not found in the mirror '{location}': {e}")
+            return None
+    else:
+        candidate = str(Path(location) / name)
+        if not os.path.exists(candidate):
+            logger.info(f"'{name}' not found in the mirror '{location}'")
+            return None
+    mirrorsum = _mirror_checksums(location).get(name, '')
+    if sha256 and mirrorsum and sha256 != mirrorsum:
+        logger.error(f"The digest of '{name}' in the mirror '{location}' does not match the "
+                     f"known digest, ignoring the mirror")
+        return None
+    if not (sha256 := sha256 or mirrorsum):
+        logger.warning(f"No digest known for '{name}', not installing it from the mirror '{location}'")
+        return None
+    return candidate, sha256
+
+
 def install_lilypond(version: tuple[int, int, int] | str = LASTVERSION,
                      osname='',
-                     arch=''
+                     arch='',
+                     stream=True,
+                     force=False,
+                     profile: str | Callable[[str], bool] = 'full',
+                     dedup=False
                      ) -> Path:
     """
     Downloads and install lilypond, expands it and returns the root path
 
+    If a mirror has been set (see :func:`set_mirror`) the archive is
+    installed from there, if present
+
+    Installation is coordinated between processes: only one process downloads
+    and extracts a given version, any other process waits for it and
+    finds the version installed. The archive is extracted to a staging folder
+    which is moved into place once complete, so that a partially extracted
+    installation is never visible
+
+    A downloaded archive is checked against the size reported by the
+    server. Its sha256 digest is verified only if known: for archives
+    installed from a mirror, from the mirror's SHA256SUMS. The release
+    urls known to this package carry no digest, so an archive downloaded
+    from them is not verified beyond its size
+
     Args:
         version: the version to download/install
         osname: one of 'linux', 'windows', 'darwin'
         arch: one of 'x86_64', 'arm64'.
+        stream: if True, .tar.gz archives are extracted while being downloaded,
+            without saving the archive, over a single connection. Otherwise
+            the archive is downloaded first, using parallel range requests
+            if the server supports them; an interrupted download is resumed
+            by the next call. .zip archives (windows) are always downloaded
+            first, since extracting them needs random access
+        force: if True, install even if this version is already installed,
+            replacing the existing installation
+        profile: which parts of the distribution to install. 'full' installs
+            everything, 'render-only' leaves out the documentation, the
+            python tools (convert-ly, lilypond-book, ...), translations and
+            editor support. A callable is used as a filter: it is called
+            with the path of each file relative to the root of the
+            installation (like 'share/doc/index.html') and should return
+            True to extract it. The profile is recorded in the install
+            index, see :func:`install_info`. An installation is kept if it
+            has the same named profile or the 'full' one; with a callable,
+            any other installation is replaced
+        dedup: if True, files which are identical to files of other
+            installed versions are replaced by hardlinks to a shared copy
+            kept in an object store within the lilyponddist folder. This
+            saves disk space, not time: the whole archive is still extracted
+            and every file is then hashed, so installing with dedup is slower
+            than without. Notice that modifying a shared file modifies it for
+            all versions
 
     Returns:
         the destination folder. This will be something like '~/.local/share/lilyponddist/lilypond-2.24.1'
@@ -153,8 +779,8 @@ def install_lilypond(version: tuple[int, int, int] | str = LASTVERSION,
     if not urls:
         raise ValueError(f"Version {versiontup} unknown. Possible versions: {_urls.keys()}")
 
-    url = urls.get((osname, arch))
-    if url is None:
+    entry = urls.get((osname, arch))
+    if entry is None:
         if osname == 'darwin' and arch == 'arm64':
             print("At the moment there is no binary package for macos arm64 for version {version}. The recommended "
                   "way to install lilypond in this case is via homebrew (https://brew.sh/). "
@@ -163,58 +789,339 @@ def install_lilypond(version: tuple[int, int, int] | str = LASTVERSION,
                   "install a native (arm64) version for your OS.")
         platforms = [f"{osname}-{arch}" for osname, arch in urls.keys()]
         raise KeyError(f"Platform {osname}-{arch} not supported. Possible platforms: {platforms}")
+    url, sha256 = _urlentry(entry)
 
-    tempdir = Path(tempfile.gettempdir())
-    payload = _download(url, tempdir, showprogress=True)
-    if not payload.exists():
-        raise OSError(f"Failed to download file {payload}, file does not exist")
+    if callable(profile):
+        keep, profilename = profile, 'custom'
+    elif profile in _install_profiles:
+        keep, profilename = _install_profiles[profile], profile
+    else:
+        raise ValueError(f"Unknown profile '{profile}', possible profiles: {list(_install_profiles.keys())}")
 
     destfolder = _lilyponddist_folder()
 
     logger.info(f"Creating folder '{destfolder}' if needed")
     destfolder.mkdir(parents=True, exist_ok=True)
 
-    logger.debug(f"Uncompressing '{payload}' to '{destfolder}'")
-    _uncompress(payload, destfolder)
+    with _install_lock(versiontup):
+        _reset_cache()
+        if versiontup in installed_versions() and not force:
+            installedprofile = install_info(versiontup).get('profile', 'full')
+            # Two custom filters cannot be compared, any custom install is redone
+            if installedprofile == 'full' or (installedprofile == profilename and not callable(profile)):
+                logger.info(f"Lilypond {versiontup} is already installed")
+                return destfolder
+            logger.info(f"Lilypond {versiontup} is installed with profile '{installedprofile}', "
+                        f"reinstalling with profile '{profilename}'")
+        # Only looked up once we know we need to install, a process which
+        # waited for another one to install this version never queries the mirror
+        if _mirror['location']:
+            if source := _mirror_source(url, sha256):
+                url, sha256 = source
+            elif not _mirror['fallback']:
+                raise RuntimeError(f"Could not install {url} from the mirror '{_mirror['location']}', "
+                                   f"and falling back to the original url is disabled")
+        from .metrics import _emit
+        t0 = time.time()
+        metadata = _install_staged(url, sha256=sha256, versiontup=versiontup, destfolder=destfolder,
+                                   stream=stream, keep=keep, dedup=dedup)
+        _emit('install', time.time() - t0, labels={'version': ".".join(map(str, versiontup)),
+                                                    'profile': profilename})
+        _update_index(destfolder, versiontup, url=url, installed=time.time(), platform=f"{osname}-{arch}",
+                      profile=profilename, **metadata)
+        _reset_cache()
+    return destfolder
 
-    assert destfolder.exists()
-    _reset_cache()
 
-    _fix_times(versiontup)
-    return destfolder
+def _install_staged(url: str, sha256: str, versiontup: tuple[int, int, int], destfolder: Path, stream: bool,
+                    keep: Callable[[str], bool] | None = None, dedup=False) -> dict:
+    """
+    Download and extract to a staging folder, move the result into place
+
+    Must be called while holding the install lock for this version
+
+    Returns:
+        any metadata to record in the install index
+    """
+    import shutil
+    import tempfile
+    import uuid
+    versionstr = ".".join(map(str, versiontup))
+    stagingprefix = f".staging-{versionstr}-"
+    # Left behind by a process which died while installing
+    for stale in destfolder.glob(stagingprefix + "*"):
+        logger.info(f"Removing stale staging folder '{stale}'")
+        shutil.rmtree(stale, ignore_errors=True)
+
+    staging = destfolder / f"{stagingprefix}{uuid.uuid4().hex}"
+    try:
+        if not _is_url(url):
+            # A local archive, from a mirror
+            payload = Path(url)
+            if sha256 and (digest := _sha256sum(payload)) != sha256:
+                raise OSError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+            logger.info(f"Extracting '{payload}'")
+            timesfixed = _uncompress(payload, staging, fixtimes=True, keep=keep)
+        elif stream and url.endswith('.tar.gz'):
+            _download_and_extract(url, staging, showprogress=True, sha256=sha256, fixtimes=True, keep=keep)
+            timesfixed = True
+        else:
+            tempdir = Path(tempfile.gettempdir())
+            payload = _download(url, tempdir, showprogress=True, sha256=sha256)
+            if not payload.exists():
+                raise OSError(f"Failed to download file {payload}, file does not exist")
+
+            logger.debug(f"Uncompressing '{payload}' to '{staging}'")
+            timesfixed = _uncompress(payload, staging, fixtimes=True, keep=keep)
+
+        stagedroot = staging / f"lilypond-{versionstr}"
+        if not stagedroot.is_dir():
+            raise RuntimeError(f"The archive {url} does not contain the expected folder "
+                               f"'{stagedroot.name}', found: {[p.name for p in staging.iterdir()]}")
+        if not timesfixed:
+            _fix_times(versiontup, root=stagedroot)
+
+        metadata = {}
+        if dedup:
+            linked, saved = _dedup_tree(stagedroot, _objectstore())
+            metadata['dedup'] = {'linked': linked, 'saved': saved}
+
+        root = destfolder / stagedroot.name
+        if root.exists():
+            # Replacing an existing installation: move it out of the way first
+            # so that the new one appears atomically
+            old = staging / ".old"
+            os.rename(root, old)
+        os.rename(stagedroot, root)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return metadata
+
+
+def _objectstore() -> Path:
+    return _lilyponddist_folder() / 'objects'
+
+
+def _dedup_tree(root: Path, store: Path, minsize=1024) -> tuple[int, int]:
+    """
+    Replace files under root by hardlinks to identical files in the object store
+
+    Files not yet in the store are added to it (as a hardlink, so without
+    copying). Objects are named after the sha256 of their content, with the
+    suffix '.x' for executables. Compiled guile files are never shared,
+    since their modification time must be newer than that of their sources
+    within each installation
+
+    This runs after extraction: every file is written first and then hashed,
+    so deduplicating adds to the time of an installation
+
+    Args:
+        root: the root of an installation
+        store: the object store
+        minsize: files smaller than this are not shared
+
+    Returns:
+        a tuple (number of files linked to existing objects, bytes saved)
+    """
+    import stat
+    linked, saved = 0, 0
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+                continue
+            st = entry.stat(follow_symlinks=False)
+            if not stat.S_ISREG(st.st_mode) or st.st_size < minsize or entry.name.endswith('.go'):
+                continue
+            digest = _sha256sum(Path(entry.path))
+            obj = store / digest[:2] / (digest + ('.x' if st.st_mode & 0o111 else ''))
+            try:
+                if not obj.exists():
+                    obj.parent.mkdir(parents=True, exist_ok=True)
+                    try:
+                        os.link(entry.path, obj)
+                        continue
+                    except FileExistsError:
+                        # Added by another process in the meantime
+                        pass
+                tmp = f"{entry.path}.lnk"
+                os.link(obj, tmp)
+                os.replace(tmp, entry.path)
+            except OSError as e:
+                logger.warning(f"Could not deduplicate files, hardlinks not supported? ({e})")
+                return linked, saved
+            linked += 1
+            saved += st.st_size
+    logger.info(f"Linked {linked} files to shared copies, saving {saved / 2**20:.1f} MB")
+    return linked, saved
+
+
+def _gc_objects(store: Path) -> int:
+    """
+    Remove objects from the store which are not used by any installation
+
+    Returns:
+        the number of bytes freed
+    """
+    freed = 0
+    if not store.exists():
+        return 0
+    for prefix in os.scandir(store):
+        for obj in os.scandir(prefix.path):
+            # DirEntry.stat() leaves st_nlink at 0 on windows
+            st = os.stat(obj.path, follow_symlinks=False)
+            if st.st_nlink <= 1:
+                os.remove(obj.path)
+                freed += st.st_size
+    return freed
 
 
 def _is_first_run() -> bool:
     return not _lilyponddist_folder().exists()
 
 
-def _fix_times(version: tuple[int, int, int]):
-    lilyroot = lilypondroot()
-    if lilyroot is None or not lilyroot.exists():
-        raise RuntimeError(f"Folder '{lilyroot}' does not exist")
-
-    major, minor, patch = version
-    versionstr = f"{major}.{minor}.{patch}"
+def _ccache_folders(lilyroot: Path, version: tuple[int, int, int]) -> list[tuple[Path, Path]]:
+    """
+    The folders holding compiled guile files, each paired with the folder of its sources
 
-    guileroot = lilyroot / "lib/guile"
+    Returns:
+        a list of (ccachefolder, sourcefolder)
+    """
+    versionstr = ".".join(map(str, version))
+    out = []
     # match any version "<lilypondroot>/lib/guile/?.?/ccache". Depending on the lilypond version
     # this can be 2.2 or 3.0
-    for guiledir in guileroot.glob("?.?"):
+    for guiledir in (lilyroot / "lib/guile").glob("?.?"):
         guilecache = guiledir / "ccache"
         if guilecache.exists():
-            for f in guilecache.rglob("*.go"):
-                f.touch(exist_ok=True)
-            logger.info(f"Fixed times of lilyponds guile cache {guilecache}")
+            out.append((guilecache, lilyroot / "share/guile" / guiledir.name))
         else:
             logger.warning(f"Guile cache not found: '{guilecache}'")
 
-    ccache = lilyroot / f"lib/lilypond/{versionstr}/ccache/lily"
-    if ccache.exists():
-        for f in ccache.rglob("*.go"):
-            f.touch(exist_ok=True)
-        logger.info(f"Fixed times of lilyponds binaries at {ccache}")
+    ccache = lilyroot / f"lib/lilypond/{versionstr}/ccache"
+    if (ccache / "lily").exists():
+        out.append((ccache, lilyroot / f"share/lilypond/{versionstr}/scm"))
     else:
-        logger.warning(f"Lilypond .go cached files not found: {ccache}/*.go")
+        logger.warning(f"Lilypond .go cached files not found: {ccache}/lily/*.go")
+    return out
+
+
+def _scan_files(folder: str, suffix: str) -> list[str]:
+    """
+    All files under folder ending with suffix, recursively
+    """
+    out = []
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    out.append(entry.path)
+    return out
+
+
+def _fix_times(version: tuple[int, int, int], root: Path | None = None, workers=0):
+    """
+    Set the modification time of all compiled guile files (.go) to now
+
+    Otherwise guile might find them older than their sources and recompile
+    them at startup. The files are touched in batches within a thread pool,
+    which pays off on slow or network filesystems
+
+    Args:
+        version: the lilypond version
+        root: the root of the installation. If not given, the root
+            of the installed version is used
+        workers: number of threads, 0 to use a default
+    """
+    import concurrent.futures
+    from .metrics import _emit
+    t0 = time.time()
+    lilyroot = root or lilypondroot(".".join(map(str, version)))
+    if lilyroot is None or not lilyroot.exists():
+        raise RuntimeError(f"Folder '{lilyroot}' does not exist")
+
+    files = []
+    for ccache, _ in _ccache_folders(lilyroot, version):
+        files.extend(_scan_files(str(ccache), '.go'))
+    if not files:
+        return
+
+    now = time.time_ns()
+
+    def touch(batch: list[str]):
+        for path in batch:
+            os.utime(path, ns=(now, now))
+
+    if not workers:
+        workers = min(32, (os.cpu_count() or 1) * 4)
+    batchsize = max(64, -(-len(files) // workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(touch, files[i:i+batchsize]) for i in range(0, len(files), batchsize)]
+        for future in futures:
+            future.result()
+    _emit('fixtimes', time.time() - t0, files=len(files))
+    logger.info(f"Fixed times of {len(files)} compiled files in {lilyroot}")
+
+
+def _stale_ccache(lilyroot: Path, version: tuple[int, int, int]) -> list[Path]:
+    """
+    Compiled guile files which are older than their source
+    """
+    stale = []
+    for ccache, sources in _ccache_folders(lilyroot, version):
+        for gofile in _scan_files(str(ccache), '.go'):
+            relpath = Path(gofile).relative_to(ccache).with_suffix('.scm')
+            # lilypond's own modules are compiled to ccache/lily/*.go from scm/*.scm
+            candidates = [sources / relpath]
+            if len(relpath.parts) > 1:
+                candidates.append(sources.joinpath(*relpath.parts[1:]))
+            for source in candidates:
+                try:
+                    if os.stat(gofile).st_mtime_ns < os.stat(source).st_mtime_ns:
+                        stale.append(Path(gofile))
+                    break
+                except FileNotFoundError:
+                    continue
+    return stale
+
+
+def check_ccache(version='') -> list[Path]:
+    """
+    Check that no compiled guile file is older than its source
+
+    Stale compiled files make lilypond recompile its scheme code at
+    startup, which is slow. Use :func:`repair_ccache` to fix them
+
+    Args:
+        version: the installed version to check. If not given, the latest installed
+
+    Returns:
+        a list of stale compiled files. An empty list if the installation is fine
+    """
+    lilyroot = lilypondroot(version)
+    if lilyroot is None:
+        raise RuntimeError(f"Lilypond version '{version}' is not installed")
+    versiontup = _parse_versionstr(version) if version else max(installed_versions().keys())
+    return _stale_ccache(lilyroot, versiontup)
+
+
+def repair_ccache(version='') -> None:
+    """
+    Make all compiled guile files of an installation newer than their sources
+
+    Args:
+        version: the installed version to repair. If not given, the latest installed
+    """
+    versiontup = _parse_versionstr(version) if version else max(installed_versions().keys(), default=None)
+    if versiontup is None:
+        raise RuntimeError("No lilypond version installed")
+    _fix_times(versiontup)
 
 
 def available_versions() -> list[tuple[str, list[str]]]:
@@ -273,8 +1180,23 @@ def installed_versions() -> dict[tuple[int, int, int], Path]:
 
     These are versions installed by lilyponddist in its own location,
     we never query the system for any other kind of installation
+
+    The result is read from an index file kept within the lilyponddist folder.
+    The index is only trusted if the folder has not been modified since
+    the index was written. Otherwise the folder is scanned and the index
+    is updated
     """
     base = _lilyponddist_folder()
+    index = _read_index(base)
+    if index is None:
+        if not base.exists():
+            return {}
+        index = _update_index(base)
+    return {_parse_versionstr(versionstr): Path(entry['root'])
+            for versionstr, entry in index.items()}
+
+
+def _scan_installed(base: Path) -> dict[tuple[int, int, int], Path]:
     exe = _lilyexe()
     out = {}
 
@@ -289,6 +1211,341 @@ def installed_versions() -> dict[tuple[int, int, int], Path]:
     return out
 
 
+def _index_path(base: Path) -> Path:
+    # The index lives in its own folder: writing it must not modify
+    # the mtime of the base folder, which is used to validate it
+    return base / 'index' / 'installed.json'
+
+
+def _read_index(base: Path) -> dict[str, dict] | None:
+    """
+    Read the install index, returns None if missing or outdated
+
+    Returns:
+        a dict mapping versionstr to a dict with the keys 'root', 'bin' and
+        any metadata recorded at installation
+    """
+    import json
+    try:
+        with open(_index_path(base)) as f:
+            index = json.load(f)
+        if index.get('format') != 1 or index.get('mtime_ns') != os.stat(base).st_mtime_ns:
+            return None
+        return index['versions']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _update_index(base: Path, version: tuple[int, int, int] | None = None, **metadata) -> dict[str, dict]:
+    """
+    Rescan the installations and write the index atomically
+
+    Metadata of versions already in the index is kept
+
+    Args:
+        base: the lilyponddist folder
+        version: if given, the version to which the metadata refers
+        metadata: any metadata to record for version
+
+    Returns:
+        the versions written to the index, as returned by _read_index
+    """
+    import json
+    import uuid
+    indexpath = _index_path(base)
+    try:
+        indexpath.parent.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        logger.debug(f"Could not create the index folder: {e}")
+        return _index_entries(_scan_installed(base), {})
+
+    with _FileLock(indexpath.with_suffix('.lock')):
+        try:
+            with open(indexpath) as f:
+                previous = json.load(f).get('versions', {})
+        except (OSError, ValueError):
+            previous = {}
+        # Any modification after this point invalidates the index we write
+        mtime_ns = os.stat(base).st_mtime_ns
+        entries = _index_entries(_scan_installed(base), previous)
+        if version is not None and (entry := entries.get(".".join(map(str, version)))):
+            entry.update(metadata)
+        tmp = indexpath.with_name(f"{indexpath.name}.{uuid.uuid4().hex}")
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'format': 1, 'mtime_ns': mtime_ns, 'versions': entries}, f, indent=2)
+            os.replace(tmp, indexpath)
+        except OSError as e:
+            logger.debug(f"Could not write the index {indexpath}: {e}")
+    return entries
+
+
+def _index_entries(installed: dict[tuple[int, int, int], Path], previous: dict[str, dict]) -> dict[str, dict]:
+    out = {}
+    for versiontup, root in sorted(installed.items()):
+        versionstr = ".".join(map(str, versiontup))
+        entry = dict(previous.get(versionstr, {}))
+        if entry.get('root') != str(root):
+            entry = {}
+        entry['root'] = str(root)
+        entry['bin'] = str(root / 'bin' / _lilyexe())
+        out[versionstr] = entry
+    return out
+
+
+def install_info(version: tuple[int, int, int] | str = '') -> dict:
+    """
+    Information about an installed version, as recorded at installation
+
+    Args:
+        version: the installed version. If not given, the latest installed version
+
+    Returns:
+        a dict with the keys 'root', 'bin' and 'lastused' (the last time the
+        version was requested via :func:`lilypondbin`, as a timestamp, or 0),
+        and, if installed by this version of lilyponddist, 'url', 'installed'
+        (a timestamp), 'platform' and 'profile' (see :func:`install_lilypond`).
+        Returns an empty dict if the version is not installed
+    """
+    installed = installed_versions()
+    if not installed:
+        return {}
+    if not version:
+        versiontup = max(installed.keys())
+    elif isinstance(version, str):
+        versiontup = _parse_versionstr(version)
+    else:
+        versiontup = version
+    if versiontup not in installed:
+        return {}
+    base = _lilyponddist_folder()
+    index = _read_index(base) or _update_index(base)
+    info = dict(index.get(".".join(map(str, versiontup)), {}))
+    info['lastused'] = _lastused(versiontup)
+    return info
+
+
+def _usedpath(versiontup: tuple[int, int, int]) -> Path:
+    # Within the index folder, so that touching it does not invalidate the index
+    return _lilyponddist_folder() / 'index' / f"used-{'.'.join(map(str, versiontup))}"
+
+
+_touched: dict[tuple[int, int, int], float] = {}
+
+
+def _touch_used(versiontup: tuple[int, int, int]) -> None:
+    """
+    Record that versiontup has been used, at most once a minute per process
+    """
+    now = time.time()
+    if now - _touched.get(versiontup, 0) < 60:
+        return
+    _touched[versiontup] = now
+    path = _usedpath(versiontup)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        try:
+            path.touch()
+        except OSError as e:
+            logger.debug(f"Could not record the use of version {versiontup}: {e}")
+    except OSError as e:
+        logger.debug(f"Could not record the use of version {versiontup}: {e}")
+
+
+def _lastused(versiontup: tuple[int, int, int]) -> float:
+    try:
+        return os.stat(_usedpath(versiontup)).st_mtime
+    except OSError:
+        return 0.
+
+
+def _treesize(root: Path, unshared=False) -> int:
+    """
+    The size of all files under root
+
+    Args:
+        root: the folder to measure
+        unshared: if True, files with other hardlinks (like those shared
+            via the object store) are not counted, since removing the tree
+            does not free them
+    """
+    size = 0
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    if unshared:
+                        # DirEntry.stat() leaves st_nlink at 0 on windows
+                        st = os.stat(entry.path, follow_symlinks=False)
+                        if st.st_nlink > 1:
+                            continue
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                    size += st.st_size
+    return size
+
+
+def usage() -> dict[tuple[int, int, int], int]:
+    """
+    The disk space used by each installed version, in bytes
+
+    Files shared between versions (see the `dedup` option of
+    :func:`install_lilypond`) are counted for each version using them
+
+    Returns:
+        a dict mapping version to its size in bytes
+
+    Example
+    ~~~~~~~
+
+    >>> for version, size in usage().items():
+    ...     print(version, f"{size / 2**20:.1f} MB")
+    """
+    return {versiontup: _treesize(root) for versiontup, root in installed_versions().items()}
+
+
+def _archivenames(versions: list[tuple[int, int, int]] | None = None) -> set[str]:
+    """
+    The filenames of the archives of the given versions, or of all known versions
+    """
+    names = set()
+    for versiontup, urls in _urls.items():
+        if versions is None or versiontup in versions:
+            names.update(os.path.split(_urlentry(entry)[0])[1] for entry in urls.values())
+    return names
+
+
+def _remove_archives(versions: list[tuple[int, int, int]] | None = None) -> int:
+    """
+    Remove archives and partial downloads left in the temp folder
+
+    Args:
+        versions: remove only the archives of these versions. If not given,
+            remove the archives of all versions not being installed right now
+
+    Returns:
+        the number of bytes freed
+    """
+    import tempfile
+    names = _archivenames(versions)
+    freed = 0
+    for entry in os.scandir(tempfile.gettempdir()):
+        name = entry.name
+        if '.part' in name:
+            name = name[:name.index('.part')]
+        if name not in names:
+            continue
+        versiontup = _parse_versionstr(name.split('-')[1])
+        lock = _install_lock(versiontup, timeout=0.01)
+        try:
+            lock.acquire()
+        except TimeoutError:
+            # Being downloaded right now
+            continue
+        try:
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            freed += size
+            logger.info(f"Removed archive '{entry.path}'")
+        except OSError as e:
+            logger.debug(f"Could not remove '{entry.path}': {e}")
+        finally:
+            lock.release()
+    return freed
+
+
+def uninstall(version: tuple[int, int, int] | str) -> int:
+    """
+    Remove an installed version
+
+    The installation is first moved out of the way and then deleted, so
+    that it is never seen partially removed. Shared files no longer used
+    by any installation and any archive of this version left in the temp
+    folder are removed as well
+
+    Args:
+        version: the version to remove
+
+    Returns:
+        the number of bytes freed
+    """
+    import shutil
+    import uuid
+    versiontup = _parse_versionstr(version) if isinstance(version, str) else version
+    base = _lilyponddist_folder()
+    with _install_lock(versiontup):
+        _reset_cache()
+        root = installed_versions().get(versiontup)
+        freed = 0
+        if root is not None:
+            freed = _treesize(root, unshared=True)
+            trash = base / f".remove-{uuid.uuid4().hex}"
+            os.rename(root, trash)
+            logger.info(f"Removing lilypond {versiontup} from '{root}'")
+            shutil.rmtree(trash, ignore_errors=True)
+            _update_index(base)
+            _reset_cache()
+            _touched.pop(versiontup, None)
+            try:
+                os.remove(_usedpath(versiontup))
+            except OSError:
+                pass
+            freed += _gc_objects(_objectstore())
+    return freed + _remove_archives([versiontup])
+
+
+def prune(keep=1, maxage=0., dryrun=False) -> list[tuple[int, int, int]]:
+    """
+    Remove installed versions which have not been used recently
+
+    Versions are ranked by the last time they were requested via
+    :func:`lilypondbin` (or by their installation time, if never used).
+    The `keep` most recently used versions are always kept. Of the rest,
+    those not used within the last `maxage` seconds are removed (all of them
+    if maxage is 0). Unused shared files and any archives left in the temp
+    folder are removed as well
+
+    Args:
+        keep: number of versions to keep
+        maxage: if given, versions used within this number of seconds are kept
+        dryrun: if True, only report what would be removed
+
+    Returns:
+        the versions removed (or to be removed, if dryrun is True)
+
+    Example
+    ~~~~~~~
+
+    >>> # Keep the two versions used most recently, and any other version used within the last 30 days
+    >>> prune(keep=2, maxage=30*86400)
+    """
+    if keep < 0:
+        raise ValueError(f"keep must be >= 0, got {keep}")
+    installed = installed_versions()
+
+    def lastused(versiontup: tuple[int, int, int]) -> float:
+        return (_lastused(versiontup)
+                or install_info(versiontup).get('installed')
+                or os.stat(installed[versiontup]).st_mtime)
+
+    ranked = sorted(installed.keys(), key=lambda v: (lastused(v), v), reverse=True)
+    now = time.time()
+    candidates = [v for v in ranked[keep:] if not maxage or now - lastused(v) > maxage]
+    if dryrun:
+        return candidates
+    freed = 0
+    for versiontup in candidates:
+        freed += uninstall(versiontup)
+    freed += _gc_objects(_objectstore())
+    freed += _remove_archives()
+    logger.info(f"Pruned versions {candidates}, freed {freed / 2**20:.1f} MB")
+    return candidates
+
+
 def is_lilypond_installed() -> bool:
     """
     Returns True if lilypond is installed via lilyponddist
@@ -321,6 +1578,7 @@ def _initlib(autoupdate=False):
             logger.debug(f"Lilypond can be updated to version {LASTVERSION}")
 
 
+@functools.cache
 def get_platform(normalize=True) -> tuple[str, str]:
     """
     Return a string with current platform (system and machine architecture).
@@ -347,6 +1605,8 @@ def get_platform(normalize=True) -> tuple[str, str]:
     * amd64 -> x86_64
 
     """
+    import platform
+    import sysconfig
 
     system = platform.system().lower()
     machine = sysconfig.get_platform().split("-")[-1].lower()
@@ -449,12 +1709,81 @@ def lilypond_version() -> tuple[tuple[int, int, int], str]:
     lilybin = _find_lilypond()
     if not lilybin or not lilybin.exists():
         raise RuntimeError("Lilypond has not been installed via lilyponddist")
+    return _probe_version(lilybin)
 
+
+@functools.cache
+def _probe_version(lilybin: Path) -> tuple[tuple[int, int, int], str]:
+    """
+    Runs 'lilypond --version' for the given binary, returns (version, versionline)
+
+    The result is persisted and reused by other processes as long as the
+    binary is not modified (same path, size and modification time)
+    """
+    if (cached := _read_probe(lilybin)) is not None:
+        return cached
+    import subprocess
     proc = subprocess.run([lilybin, '--version'], capture_output=True)
     if proc.returncode != 0:
         logger.error(proc.stderr)
         raise RuntimeError(f"Error while running '{lilybin} --version', error code: {proc.returncode}")
-    for line in proc.stdout.decode().splitlines():
+    out = _parse_version_output(proc.stdout.decode())
+    _write_probe(lilybin, out)
+    return out
+
+
+def _probes_path() -> Path:
+    return _index_path(_lilyponddist_folder()).with_name('versions.json')
+
+
+def _binary_identity(lilybin: Path) -> list:
+    st = os.stat(lilybin)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _read_probe(lilybin: Path) -> tuple[tuple[int, int, int], str] | None:
+    """
+    The persisted result of probing lilybin, or None if not found or outdated
+    """
+    import json
+    try:
+        with open(_probes_path()) as f:
+            entry = json.load(f)[str(lilybin)]
+        if entry['identity'] != _binary_identity(lilybin):
+            return None
+        major, minor, patch = entry['version']
+        return ((major, minor, patch), entry['versionline'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_probe(lilybin: Path, probe: tuple[tuple[int, int, int], str]) -> None:
+    import json
+    import uuid
+    path = _probes_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with _FileLock(path.with_suffix('.lock')):
+            try:
+                with open(path) as f:
+                    probes = json.load(f)
+            except (OSError, ValueError):
+                probes = {}
+            # Drop entries for binaries which do not exist anymore
+            probes = {key: entry for key, entry in probes.items() if os.path.exists(key)}
+            probes[str(lilybin)] = {'identity': _binary_identity(lilybin),
+                                    'version': list(probe[0]),
+                                    'versionline': probe[1]}
+            tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}")
+            with open(tmp, 'w') as f:
+                json.dump(probes, f, indent=2)
+            os.replace(tmp, path)
+    except OSError as e:
+        logger.debug(f"Could not persist the version of {lilybin}: {e}")
+
+
+def _parse_version_output(output: str) -> tuple[tuple[int, int, int], str]:
+    for line in output.splitlines():
         if match := re.search(r"GNU LilyPond (\d+)\.(\d+)\.(\d+)", line):
             major = int(match.group(1))
             minor = int(match.group(2))
@@ -527,6 +1856,97 @@ def _reset_cache():
     installed_versions.cache_clear()
 
 
+_inflight: dict[tuple[int, int, int], concurrent.futures.Future] = {}
+_inflightlock = threading.Lock()
+
+
+def prefetch(version='', executor: concurrent.futures.Executor | None = None) -> concurrent.futures.Future:
+    """
+    Install lilypond in the background
+
+    The download, extraction and fixing of the installation run in a
+    background thread. Any call to :func:`lilypondbin` made while the
+    installation is in progress waits for it instead of starting a new one.
+    Calling prefetch again for the same version returns the same future
+
+    Args:
+        version: the version to install, or an empty string to install the latest version
+        executor: the executor to run the installation in. If not given, a
+            dedicated thread is used
+
+    Returns:
+        a Future which resolves to the root folder of the installed version.
+        If the version is already installed, the future is already done
+
+    Example
+    ~~~~~~~
+
+    >>> future = prefetch()
+    >>> # ... do some other initialization
+    >>> lilybin = lilypondbin()   # waits for the installation, if still in progress
+    """
+    import concurrent.futures
+    versiontup = _parse_versionstr(version) if version else LASTVERSION
+    with _inflightlock:
+        future = _inflight.get(versiontup)
+        if future is not None:
+            return future
+        root = installed_versions().get(versiontup)
+        if root is not None:
+            future = concurrent.futures.Future()
+            future.set_result(root)
+            return future
+
+        def job() -> Path:
+            install_lilypond(version=versiontup)
+            return installed_versions()[versiontup]
+
+        if executor is not None:
+            future = executor.submit(job)
+        else:
+            future = concurrent.futures.Future()
+
+            def run(future=future):
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(job())
+                except BaseException as e:
+                    future.set_exception(e)
+
+            threading.Thread(target=run, name=f"lilyponddist-prefetch-{versiontup}", daemon=True).start()
+        _inflight[versiontup] = future
+
+    def done(future, versiontup=versiontup):
+        with _inflightlock:
+            if _inflight.get(versiontup) is future:
+                del _inflight[versiontup]
+
+    future.add_done_callback(done)
+    return future
+
+
+def _join_inflight(version='') -> None:
+    """
+    Wait for any installation started via :func:`prefetch`
+
+    Args:
+        version: wait for this version only. If not given, wait for all
+    """
+    if not _inflight:
+        return
+    import concurrent.futures
+    with _inflightlock:
+        if version:
+            futures = [future for versiontup, future in _inflight.items()
+                       if versiontup == _parse_versionstr(version)]
+        else:
+            futures = list(_inflight.values())
+    if futures:
+        logger.debug("Waiting for an installation in progress")
+        concurrent.futures.wait(futures)
+
+
 def lilypondbin(version='') -> Path:
     """
     Get the lilypond binary for this platform.
@@ -539,15 +1959,18 @@ def lilypondbin(version='') -> Path:
     Returns:
         the path of the lilypond binary as a Path object
     """
+    _join_inflight(version)
     installed = installed_versions()
     if not installed:
-        install_lilypond(version=version)
+        prefetch(version=version).result()
         installed = installed_versions()
         if not installed:
             raise RuntimeError(f"Could not install version '{version}'")
 
     lily = _find_lilypond(version=version)
-    if not lily:
+    if lily:
+        _touch_used(_parse_versionstr(version) if version else max(installed.keys()))
+    else:
         available = available_versions()
         raise RuntimeError(f"Could not find lilypond binary for version '{version}'. "
                            f"Installed versions: {installed.keys()}, available versions: {available}")
@@ -562,6 +1985,46 @@ def lilypondbin(version='') -> Path:
 _get_platform = get_platform
 
 
+# Public names defined in submodules, imported when first accessed
+_lazyattrs = {
+    'RenderError': '_render',
+    'RenderResult': '_render',
+    'render': '_render',
+    'render_many': '_render',
+    'render_bytes': '_render',
+    'render_pages': '_render',
+    'WarmupReport': '_render',
+    'warmup': '_render',
+    'RenderDaemon': 'daemon',
+    'RenderDaemonPool': 'daemon',
+    'RenderCache': 'cache',
+    'ainstall_lilypond': 'aio',
+    'alilypond_version': 'aio',
+    'alilypondbin': 'aio',
+    'arender': 'aio',
+    'sync_mirror': 'mirror',
+    'add_listener': 'metrics',
+    'remove_listener': 'metrics',
+    'get_metrics': 'metrics',
+    'reset_metrics': 'metrics',
+    'build': '_build',
+}
+
+
+def __getattr__(name: str):
+    submodule = _lazyattrs.get(name)
+    if submodule is None:
+        raise AttributeError(f"module 'lilyponddist' has no attribute '{name}'")
+    import importlib
+    value = getattr(importlib.import_module(f'.{submodule}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_lazyattrs.keys()))
+
+
 # if _is_first_run():
 #     print()
 #     print("*****************************************************")
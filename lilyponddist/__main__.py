@@ -0,0 +1,103 @@
+"""
+Command line interface: python -m lilyponddist <command>
+"""
+from __future__ import annotations
+import argparse
+import sys
+import time
+
+
+def _warmup(args) -> int:
+    from . import warmup
+    report = warmup(version=args.version, runs=args.runs)
+    print(f"binary:     {report.lilybin}")
+    print(f"cold:       {report.cold:.3f} s")
+    print(f"warm:       {report.warm:.3f} s")
+    print(f"stale:      {report.stale}")
+    print(f"recompiled: {report.recompiled}")
+    print(f"repaired:   {report.repaired}")
+    return 0
+
+
+def _usage(args) -> int:
+    from . import install_info, usage
+    for version, size in sorted(usage().items()):
+        lastused = install_info(version).get('lastused')
+        when = time.strftime('%Y-%m-%d %H:%M', time.localtime(lastused)) if lastused else 'never'
+        print(f"{'.'.join(map(str, version)):<10} {size / 2**20:8.1f} MB   last used: {when}")
+    return 0
+
+
+def _prune(args) -> int:
+    from . import prune
+    removed = prune(keep=args.keep, maxage=args.days * 86400, dryrun=args.dry_run)
+    for version in removed:
+        print(('Would remove ' if args.dry_run else 'Removed ') + '.'.join(map(str, version)))
+    return 0
+
+
+def _mirror_sync(args) -> int:
+    from . import sync_mirror
+    archives = sync_mirror(args.folder, platforms=args.platform or (), versions=args.version or ())
+    for archive in archives:
+        print(archive)
+    return 0
+
+
+def _build(args) -> int:
+    from . import build
+    results = build(args.paths, formats=args.formats.split(','), outdir=args.outdir, version=args.version,
+                    workers=args.workers, force=args.force)
+    failed = [result for result in results if not result.ok]
+    for result in failed:
+        print(f"Failed: {result.source}\n{result.stderr}", file=sys.stderr)
+    print(f"Rendered {len(results) - len(failed)} files, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='lilyponddist')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('warmup', help='Render once to check the installation and warm up its caches')
+    p.add_argument('--version', default='', help='The lilypond version, defaults to the latest installed')
+    p.add_argument('--runs', type=int, default=2, help='Number of warm renders to measure')
+    p.set_defaults(func=_warmup)
+
+    p = subparsers.add_parser('usage', help='Show the disk space used by each installed version')
+    p.set_defaults(func=_usage)
+
+    p = subparsers.add_parser('prune', help='Remove versions which have not been used recently')
+    p.add_argument('--keep', type=int, default=1, help='Number of most recently used versions to keep')
+    p.add_argument('--days', type=float, default=0,
+                   help='Also keep any version used within this number of days')
+    p.add_argument('--dry-run', action='store_true', help='Only show which versions would be removed')
+    p.set_defaults(func=_prune)
+
+    p = subparsers.add_parser('mirror', help='Manage a mirror of the release archives')
+    mirrorparsers = p.add_subparsers(dest='action', required=True)
+    p = mirrorparsers.add_parser('sync', help='Download the release archives to a mirror folder')
+    p.add_argument('folder', help='The mirror folder')
+    p.add_argument('--platform', action='append',
+                   help='A platform to mirror, like linux-x86_64. Can be given multiple times. '
+                        'Defaults to the current platform')
+    p.add_argument('--version', action='append',
+                   help='A version to mirror. Can be given multiple times. Defaults to all versions')
+    p.set_defaults(func=_mirror_sync)
+
+    p = subparsers.add_parser('build', help='Render the files which changed since the last build, '
+                                            'or which include files which changed')
+    p.add_argument('paths', nargs='+', help='The .ly files to build')
+    p.add_argument('--formats', default='pdf', help='Comma separated list of output formats')
+    p.add_argument('--outdir', default='', help='The output folder, defaults to the folder of each source')
+    p.add_argument('--version', default='', help='The lilypond version, defaults to the latest installed')
+    p.add_argument('--workers', type=int, default=0, help='Number of parallel lilypond processes')
+    p.add_argument('--force', action='store_true', help='Render all files')
+    p.set_defaults(func=_build)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""
+Incremental builds of many .ly files
+
+:func:`build` renders only the files which changed since the last build,
+either themselves or any of the files they include. What each output was
+built from is recorded in a state file, similar to what make does with
+timestamps, but based on the content of the files
+"""
+from __future__ import annotations
+
+from pathlib import Path
+import hashlib
+import json
+import os
+import uuid
+
+from . import _probe_version, _sha256sum, lilypondbin, logger
+from .cache import _includepaths, resolve_includes
+from ._render import RenderResult, _formatargs, render_many
+
+from typing import Sequence
+
+
+_statefilename = '.lilyponddist-build.json'
+
+
+class _Fingerprints:
+    """
+    Content digests of files, recomputed only if their size or mtime changed
+
+    Args:
+        known: a dict mapping path to [size, mtime_ns, sha256], as recorded
+            by a previous build
+    """
+
+    def __init__(self, known: dict[str, list]):
+        self.known = known
+        self.current: dict[str, list] = {}
+
+    def __call__(self, path: Path) -> list:
+        key = str(path)
+        if (entry := self.current.get(key)) is not None:
+            return entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            entry = [-1, 0, '']
+        else:
+            entry = self.known.get(key)
+            if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                entry = [st.st_size, st.st_mtime_ns, _sha256sum(path)]
+        self.current[key] = entry
+        return entry
+
+
+def _readstate(statefile: Path) -> dict:
+    try:
+        with open(statefile) as f:
+            state = json.load(f)
+        if state.get('format') == 1:
+            return state
+    except (OSError, ValueError):
+        pass
+    return {'format': 1, 'targets': {}, 'files': {}}
+
+
+def _writestate(statefile: Path, state: dict) -> None:
+    tmp = statefile.with_name(f"{statefile.name}.{uuid.uuid4().hex}")
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(tmp, statefile)
+    except OSError as e:
+        logger.error(f"Could not write the build state {statefile}: {e}")
+
+
+def build(paths: Sequence[str | Path],
+          formats: Sequence[str] = ('pdf',),
+          outdir: str | Path = '',
+          version='',
+          args: Sequence[str] = (),
+          workers: int = 0,
+          force=False,
+          statefile: str | Path = ''
+          ) -> list[RenderResult]:
+    """
+    Render the files which are out of date
+
+    A file is out of date if it was never built, if any of its outputs is
+    missing, or if the content of the file itself or of any file it includes
+    (recursively, see :func:`~lilyponddist.cache.resolve_includes`) changed
+    since the last build. Changing the formats, the arguments or the lilypond
+    version also makes a file out of date. Files out of date are rendered in
+    parallel, lilypond is not called for any other file
+
+    Args:
+        paths: the .ly files to build, normally the scores and parts, not the
+            files which are only included
+        formats: the output formats, any of 'pdf', 'svg', 'png', 'ps'
+        outdir: the folder where to place the output. If not given, each
+            output is placed next to its source
+        version: the lilypond version to use, as passed to :func:`lilypondbin`
+        args: any other arguments passed to lilypond
+        workers: max. number of lilypond processes running at the same
+            time. If not given, the number of cpus is used
+        force: if True, render all files
+        statefile: the file where the state of the build is kept. If not
+            given, a file '.lilyponddist-build.json' within outdir (or within
+            the current folder, if no outdir is given)
+
+    Returns:
+        the results of the files rendered. Files which failed are rendered
+        again in the next build
+
+    Example
+    ~~~~~~~
+
+    >>> results = build(glob.glob("scores/*.ly"), formats=['pdf'], outdir='out')
+    >>> failed = [result.source for result in results if not result.ok]
+    """
+    lilybin = lilypondbin(version=version)
+    cmdargs = [*_formatargs(formats), *args]
+    if statefile:
+        statepath = Path(statefile)
+    else:
+        statepath = (Path(outdir) if outdir else Path.cwd()) / _statefilename
+    statepath = statepath.absolute()
+    statepath.parent.mkdir(parents=True, exist_ok=True)
+    state = _readstate(statepath)
+    fingerprints = _Fingerprints(state['files'])
+
+    h = hashlib.sha256()
+    h.update(_probe_version(lilybin)[1].encode())
+    h.update(b'\0'.join(arg.encode() for arg in cmdargs))
+    h.update(str(Path(outdir).absolute() if outdir else '').encode())
+    command = h.hexdigest()
+
+    includepaths = _includepaths(args)
+    stale: list[Path] = []
+    deps: dict[Path, dict[str, str]] = {}
+    for path in dict.fromkeys(Path(p).absolute() for p in paths):
+        depfiles = [path, *resolve_includes(path, includepaths=includepaths)]
+        deps[path] = {str(dep): fingerprints(dep)[2] for dep in depfiles}
+        target = state['targets'].get(str(path))
+        if (force
+                or target is None
+                or target['command'] != command
+                or target['deps'] != deps[path]
+                or not all(os.path.exists(output) for output in target['outputs'])):
+            stale.append(path)
+
+    logger.info(f"{len(stale)} of {len(deps)} files out of date")
+    results = []
+    try:
+        for result in render_many(stale, formats=formats, workers=workers, version=version, outdir=outdir,
+                                  args=args):
+            results.append(result)
+            key = str(result.source)
+            if result.ok:
+                state['targets'][key] = {'command': command,
+                                         'deps': deps[result.source],
+                                         'outputs': [str(output) for output in result.outputs]}
+            else:
+                state['targets'].pop(key, None)
+    finally:
+        # Only keep the fingerprints of files still in use
+        state['files'] = {path: entry for path, entry in fingerprints.current.items() if entry[0] >= 0}
+        _writestate(statepath, state)
+    return results
@@ -0,0 +1,618 @@
+"""
+Rendering of lilypond files using the binary installed by lilyponddist
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from pathlib import Path
+import glob
+import os
+import re
+import subprocess
+import tempfile
+import time
+import concurrent.futures
+import functools
+
+from . import check_ccache, lilypondbin, logger, repair_ccache
+from .cache import RenderCache, cachekey, default_cache
+from .metrics import _emit
+
+from typing import Iterator, Sequence
+
+
+_formatflags = {
+    'pdf': '--pdf',
+    'svg': '--svg',
+    'png': '--png',
+    'ps': '--ps'
+}
+
+
+@dataclass
+class RenderResult:
+    """
+    The result of rendering one .ly file
+
+    Attributes:
+        source: the .ly file rendered
+        returncode: the return code of the lilypond process
+        stderr: the output of lilypond. Lilypond logs everything to stderr
+        outputs: the generated files
+        elapsed: the time it took to render this file, in seconds. When
+            rendering in batches, this is the time of the whole batch
+        cached: True if the outputs were taken from the render cache
+        phases: the time spent in each phase of lilypond, in seconds, like
+            {'startup': 0.4, 'parsing': 0.05, ...}, as announced in the log.
+            When rendering in batches, these are the times of the whole batch
+    """
+    source: Path
+    returncode: int
+    stderr: str = ''
+    outputs: list[Path] = field(default_factory=list)
+    elapsed: float = 0.
+    cached: bool = False
+    phases: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        """True if lilypond succeeded"""
+        return self.returncode == 0
+
+
+class RenderError(RuntimeError):
+    """
+    Raised when lilypond fails to render a source
+
+    Attributes:
+        returncode: the return code of lilypond
+        stderr: the output of lilypond
+    """
+    def __init__(self, msg: str, returncode: int, stderr: str):
+        super().__init__(msg)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+# The messages with which lilypond announces each phase
+_phaseregex = re.compile(
+    r"(?P<parsing>Parsing\.\.\.)"
+    r"|(?P<interpreting>Interpreting music\.\.\.)"
+    r"|(?P<preprocessing>Preprocessing graphical objects\.\.\.)"
+    r"|(?P<layout>Finding the ideal number of pages|Fitting music on|Calculating (line|page) breaks)"
+    r"|(?P<output>Drawing systems|Converting to|Layout output to)")
+
+
+def _run_timed(cmd: list[str], cwd: Path) -> tuple[int, str, dict[str, float]]:
+    """
+    Run lilypond, timing its phases
+
+    The log is read while it is being written. A phase lasts from the
+    message announcing it ('Parsing...', 'Interpreting music...', etc.) to
+    the message announcing the next one, the last phase lasts until lilypond
+    exits. The time before the first message is reported as 'startup'.
+    A phase which occurs more than once (a file with many scores, or a
+    batch of files) is added up
+
+    Returns:
+        a tuple (returncode, stderr, phases)
+    """
+    import codecs
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    t0 = time.time()
+    marks = [(t0, 'startup')]
+    log = ''
+    scanned = 0
+    with subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=cwd) as proc:
+        assert proc.stderr is not None
+        fd = proc.stderr.fileno()
+        while chunk := os.read(fd, 2**16):
+            now = time.time()
+            log += decoder.decode(chunk)
+            for match in _phaseregex.finditer(log, scanned):
+                marks.append((now, match.lastgroup or ''))
+                scanned = match.end()
+            # A message might be split between reads
+            scanned = max(scanned, len(log) - 64)
+        returncode = proc.wait()
+    marks.append((time.time(), ''))
+    phases: dict[str, float] = {}
+    for (start, phase), (end, _) in zip(marks, marks[1:]):
+        phases[phase] = phases.get(phase, 0.) + end - start
+    return returncode, log + decoder.decode(b'', final=True), phases
+
+
+def _emit_render(result: RenderResult) -> None:
+    status = 'cached' if result.cached else 'ok' if result.ok else 'error'
+    _emit('render', result.elapsed, labels={'status': status})
+    for phase, duration in result.phases.items():
+        _emit('render_phase', duration, labels={'phase': phase})
+
+
+def _formatargs(formats: Sequence[str]) -> list[str]:
+    args = []
+    for fmt in formats:
+        flag = _formatflags.get(fmt)
+        if flag is None:
+            raise ValueError(f"Format '{fmt}' not supported, possible formats: {list(_formatflags.keys())}")
+        args.append(flag)
+    return args
+
+
+# The suffix of the files of a multipage output: '-2' or, for png, '-page2'
+_pagesuffix = re.compile(r"-(?:page)?([0-9]+)$")
+
+# Formats saved as one file per page. pdf and ps always hold the whole score
+_pagedformats = ('svg', 'png')
+
+
+def _collect_outputs(outbase: Path, formats: Sequence[str], since=0.) -> list[Path]:
+    """
+    Find the files generated by lilypond for the given output basename
+
+    Multipage png/svg output is saved as <outbase>-<page>.<fmt> (png
+    as <outbase>-page<page>.<fmt> in recent versions), single page output
+    as <outbase>.<fmt>. Pages are returned in page order. Files of other
+    sources sharing the prefix (like <outbase>-parts.<fmt>, or <outbase>-2.pdf
+    for a source named <outbase>-2.ly) are not included
+    """
+    outputs = []
+    for fmt in formats:
+        candidates = [outbase.with_name(f"{outbase.name}.{fmt}")]
+        if fmt in _pagedformats:
+            pages = []
+            for candidate in outbase.parent.glob(f"{glob.escape(outbase.name)}-*.{fmt}"):
+                suffix = candidate.name[len(outbase.name):-len(fmt) - 1]
+                if match := _pagesuffix.fullmatch(suffix):
+                    pages.append((int(match.group(1)), candidate))
+            candidates.extend(candidate for _, candidate in sorted(pages))
+        for candidate in candidates:
+            if candidate.exists() and candidate.stat().st_mtime >= since:
+                outputs.append(candidate)
+    return outputs
+
+
+def _getcache(cache: RenderCache | bool | None) -> RenderCache | None:
+    if cache is True:
+        return default_cache()
+    return cache or None
+
+
+def _fromcache(cache: RenderCache, key: str, path: Path, outbase: Path) -> RenderResult | None:
+    t0 = time.time()
+    outputs = cache.get(key, outbase)
+    if outputs is None:
+        return None
+    result = RenderResult(source=path, returncode=0, outputs=outputs, elapsed=time.time() - t0, cached=True)
+    _emit_render(result)
+    return result
+
+
+def render(path: str | Path,
+           formats: Sequence[str] = ('pdf',),
+           outdir: str | Path = '',
+           version='',
+           args: Sequence[str] = (),
+           lilybin: Path | None = None,
+           cache: RenderCache | bool | None = None
+           ) -> RenderResult:
+    """
+    Render a .ly file
+
+    Args:
+        path: the .ly file to render
+        formats: the output formats, any of 'pdf', 'svg', 'png', 'ps'
+        outdir: the folder where to place the output. If not given, the
+            output is placed next to the source
+        version: the lilypond version to use, as passed to :func:`lilypondbin`
+        args: any other arguments passed to lilypond
+        lilybin: the lilypond binary to use. If given, version is ignored
+        cache: a :class:`RenderCache`, or True to use the default cache. On
+            a cache hit the stored outputs are copied to the output folder
+            without running lilypond
+
+    Returns:
+        a :class:`RenderResult`
+    """
+    path = Path(path).absolute()
+    outfolder = Path(outdir).absolute() if outdir else path.parent
+    outfolder.mkdir(parents=True, exist_ok=True)
+    outbase = outfolder / path.stem
+    if lilybin is None:
+        lilybin = lilypondbin(version=version)
+    cmdargs = [*_formatargs(formats), *args]
+    rendercache = _getcache(cache)
+    key = ''
+    if rendercache is not None:
+        key = cachekey(path, lilybin, cmdargs)
+        if (result := _fromcache(rendercache, key, path, outbase)) is not None:
+            return result
+    cmd = [str(lilybin), *cmdargs, '-o', str(outbase), str(path)]
+    logger.debug(f"Rendering '{path}': {cmd}")
+    t0 = time.time()
+    returncode, stderr, phases = _run_timed(cmd, cwd=path.parent)
+    elapsed = time.time() - t0
+    if returncode != 0:
+        logger.error(f"Error rendering '{path}', return code: {returncode}")
+    # Some filesystems have a coarse mtime resolution
+    outputs = _collect_outputs(outbase, formats, since=int(t0) - 1)
+    if rendercache is not None and returncode == 0:
+        rendercache.put(key, outputs, outbase)
+    result = RenderResult(source=path,
+                          returncode=returncode,
+                          stderr=stderr,
+                          outputs=outputs,
+                          elapsed=elapsed,
+                          phases=phases)
+    _emit_render(result)
+    return result
+
+
+def _split_log(stderr: str, paths: Sequence[Path]) -> dict[Path, str]:
+    """
+    Split the log of a lilypond run over many files into one log per file
+
+    Lilypond prints "Processing `<file>'" before starting with each file
+    """
+    logs: dict[Path, list[str]] = {path: [] for path in paths}
+    current: list[str] | None = None
+    for line in stderr.splitlines(keepends=True):
+        if match := re.match(r"Processing `(.+)'", line):
+            current = logs.get(Path(match.group(1)))
+        if current is not None:
+            current.append(line)
+    return {path: ''.join(lines) for path, lines in logs.items()}
+
+
+# An error reported by lilypond: "<file>:<line>:<col>: error: ...", "error: ..."
+# or "fatal error: ...". Warnings and "programming error" do not make it fail
+_errorregex = re.compile(r"^(?:.*?:[0-9]+:[0-9]+: )?(?:fatal )?error:", re.MULTILINE)
+
+
+def _render_batch(paths: Sequence[Path],
+                  formats: Sequence[str],
+                  outfolder: Path,
+                  args: Sequence[str],
+                  lilybin: Path
+                  ) -> list[RenderResult]:
+    """
+    Render many files with one lilypond invocation
+
+    All outputs are placed in outfolder. The log and the outputs are
+    mapped back to each source
+    """
+    outfolder.mkdir(parents=True, exist_ok=True)
+    cmd = [str(lilybin), *_formatargs(formats), *args, '-o', str(outfolder), *map(str, paths)]
+    logger.debug(f"Rendering {len(paths)} files in one batch: {cmd}")
+    t0 = time.time()
+    batchreturncode, stderr, phases = _run_timed(cmd, cwd=outfolder)
+    elapsed = time.time() - t0
+    logs = _split_log(stderr, paths)
+    results = []
+    for path in paths:
+        log = logs[path]
+        outputs = _collect_outputs(outfolder / path.stem, formats, since=int(t0) - 1)
+        if _errorregex.search(log):
+            returncode = batchreturncode or 1
+        elif not outputs:
+            returncode = batchreturncode
+        elif not log and batchreturncode != 0:
+            # Without a log (lilypond called with '-s' or '--loglevel=ERROR')
+            # a failure cannot be attributed to any file of the batch
+            returncode = batchreturncode
+        else:
+            returncode = 0
+        if returncode != 0:
+            logger.error(f"Error rendering '{path}'")
+        results.append(RenderResult(source=path, returncode=returncode, stderr=log,
+                                    outputs=outputs, elapsed=elapsed, phases=phases))
+    _emit('render', elapsed, labels={'status': 'ok' if batchreturncode == 0 else 'error'})
+    for phase, duration in phases.items():
+        _emit('render_phase', duration, labels={'phase': phase})
+    return results
+
+
+def _make_batches(paths: Sequence[Path], outdir: str | Path, chunksize: int
+                  ) -> list[tuple[Path, list[Path]]]:
+    """
+    Group paths by output folder, each group split in chunks of at most chunksize
+    """
+    groups: dict[Path, list[Path]] = {}
+    for path in paths:
+        outfolder = Path(outdir).absolute() if outdir else path.parent
+        groups.setdefault(outfolder, []).append(path)
+    batches = []
+    for outfolder, group in groups.items():
+        # Two sources with the same name in one batch would overwrite
+        # each other's output
+        chunk: list[Path] = []
+        stems: set[str] = set()
+        for path in group:
+            if len(chunk) >= chunksize or path.stem in stems:
+                batches.append((outfolder, chunk))
+                chunk, stems = [], set()
+            chunk.append(path)
+            stems.add(path.stem)
+        if chunk:
+            batches.append((outfolder, chunk))
+    return batches
+
+
+def render_many(paths: Sequence[str | Path],
+                formats: Sequence[str] = ('pdf',),
+                workers: int = 0,
+                version='',
+                outdir: str | Path = '',
+                args: Sequence[str] = (),
+                chunksize: int = 1,
+                cache: RenderCache | bool | None = None
+                ) -> Iterator[RenderResult]:
+    """
+    Render many .ly files in parallel
+
+    Files are rendered in chunks of `chunksize` files, each chunk by its
+    own lilypond process. At most `workers` processes run at the same
+    time. Results are yielded as soon as each job finishes, which is not
+    necessarily the order of `paths`
+
+    Rendering many files with one lilypond invocation saves the startup
+    time of lilypond for each file, which can be the largest part of the
+    time needed to render a short snippet. The drawback is that a failing
+    file is only reported once the whole chunk has finished
+
+    Args:
+        paths: the .ly files to render
+        formats: the output formats, any of 'pdf', 'svg', 'png', 'ps'
+        workers: max. number of lilypond processes running at the same
+            time. If not given, the number of cpus is used
+        version: the lilypond version to use, as passed to :func:`lilypondbin`
+        outdir: the folder where to place the output. If not given, each
+            output is placed next to its source
+        args: any other arguments passed to lilypond. When rendering in
+            chunks, '-djob-count' is not supported: the log of each job is
+            written to a file instead of being reported
+        chunksize: number of files rendered by each lilypond process
+        cache: a :class:`RenderCache`, or True to use the default cache
+
+    Returns:
+        an iterator of :class:`RenderResult`
+
+    Example
+    ~~~~~~~
+
+    >>> for result in render_many(glob.glob("scores/*.ly"), formats=['pdf', 'png'], workers=8):
+    ...     if not result.ok:
+    ...         print(result.source, result.stderr)
+    """
+    if not paths:
+        return
+    if chunksize < 1:
+        raise ValueError(f"chunksize must be >= 1, got {chunksize}")
+    if chunksize > 1 and any('job-count' in arg for arg in args):
+        raise ValueError("-djob-count is not supported when rendering in chunks, use workers instead")
+    _formatargs(formats)
+    # Resolve the binary once, this might trigger an installation
+    lilybin = lilypondbin(version=version)
+    if not workers:
+        workers = os.cpu_count() or 1
+    abspaths = [Path(path).absolute() for path in paths]
+    # Each job spends its time waiting on its own lilypond process, so
+    # a thread per job is enough to keep `workers` processes busy
+    rendercache = _getcache(cache)
+    if chunksize == 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+            futures = [executor.submit(render, path, formats=formats, outdir=outdir, args=args, lilybin=lilybin,
+                                       cache=rendercache)
+                       for path in abspaths]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        return
+
+    keys: dict[Path, str] = {}
+    if rendercache is not None:
+        cmdargs = [*_formatargs(formats), *args]
+        pending = []
+        for path in abspaths:
+            key = keys[path] = cachekey(path, lilybin, cmdargs)
+            outbase = (Path(outdir).absolute() if outdir else path.parent) / path.stem
+            if (result := _fromcache(rendercache, key, path, outbase)) is not None:
+                yield result
+            else:
+                pending.append(path)
+        abspaths = pending
+        if not abspaths:
+            return
+
+    batches = _make_batches(abspaths, outdir=outdir, chunksize=chunksize)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(batches))) as executor:
+        batchfutures = {executor.submit(_render_batch, batch, formats=formats, outfolder=outfolder,
+                                        args=args, lilybin=lilybin): outfolder
+                        for outfolder, batch in batches}
+        for batchfuture in concurrent.futures.as_completed(batchfutures):
+            for result in batchfuture.result():
+                if rendercache is not None and result.ok:
+                    rendercache.put(keys[result.source], result.outputs,
+                                    batchfutures[batchfuture] / result.source.stem)
+                yield result
+
+
+@functools.cache
+def _scratchroot() -> str:
+    """
+    The folder where scratch files are placed, preferably a memory backed filesystem
+    """
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK | os.X_OK):
+        return shm
+    return tempfile.gettempdir()
+
+
+def render_pages(source: str,
+                 fmt='svg',
+                 version='',
+                 args: Sequence[str] = ()
+                 ) -> list[bytes]:
+    """
+    Render lilypond source code, returns the content of each generated file
+
+    The source is passed to lilypond via stdin. Any file lilypond needs to
+    write is placed in a scratch folder (within /dev/shm if available),
+    which is removed before returning.
+
+    Args:
+        source: the lilypond source code
+        fmt: the output format, one of 'svg', 'pdf', 'png', 'ps'
+        version: the lilypond version to use, as passed to :func:`lilypondbin`
+        args: any other arguments passed to lilypond. Since the source
+            has no location, relative includes need an include path ('-I <folder>')
+
+    Returns:
+        a list with the content of each file generated, in page order. For
+        'pdf' and 'ps' this is always one file with all pages
+
+    Raises:
+        RenderError: if lilypond fails
+    """
+    returncode, stderr, pages = _render_source(source, fmt=fmt, lilybin=lilypondbin(version=version), args=args)
+    if returncode != 0 or not pages:
+        raise RenderError(f"Error rendering source, return code: {returncode}\n{stderr}",
+                          returncode=returncode, stderr=stderr)
+    return pages
+
+
+def _render_source(source: str, fmt: str, lilybin: Path, args: Sequence[str] = ()
+                   ) -> tuple[int, str, list[bytes]]:
+    """
+    Render source via stdin within a scratch folder
+
+    Returns:
+        a tuple (returncode, stderr, pages)
+    """
+    with tempfile.TemporaryDirectory(prefix='lilyponddist-', dir=_scratchroot()) as scratch:
+        outbase = Path(scratch) / 'out'
+        cmd = [str(lilybin), *_formatargs([fmt]), *args, '-o', str(outbase), '-']
+        proc = subprocess.run(cmd, input=source.encode(), capture_output=True, cwd=scratch)
+        # Pages are returned in page order
+        outputs = _collect_outputs(outbase, [fmt])
+        return proc.returncode, proc.stderr.decode(errors='replace'), [output.read_bytes() for output in outputs]
+
+
+def render_bytes(source: str,
+                 fmt='svg',
+                 version='',
+                 args: Sequence[str] = ()
+                 ) -> bytes:
+    """
+    Render lilypond source code, returns the generated file as bytes
+
+    Like :func:`render_pages`, but returns only the first file. For 'pdf'
+    and 'ps' this holds the whole score. For 'svg' and 'png' a score with
+    multiple pages generates one file per page, use :func:`render_pages`
+    to get all of them
+
+    Args:
+        source: the lilypond source code
+        fmt: the output format, one of 'svg', 'pdf', 'png', 'ps'
+        version: the lilypond version to use, as passed to :func:`lilypondbin`
+        args: any other arguments passed to lilypond
+
+    Returns:
+        the content of the generated file
+
+    Raises:
+        RenderError: if lilypond fails
+
+    Example
+    ~~~~~~~
+
+    >>> svg = render_bytes(r'{ c\'4 d\' e\' }', fmt='svg')
+    """
+    return render_pages(source, fmt=fmt, version=version, args=args)[0]
+
+
+@dataclass
+class WarmupReport:
+    """
+    The result of :func:`warmup`
+
+    Attributes:
+        lilybin: the lilypond binary
+        cold: time of the first render, in seconds
+        warm: time of the fastest of the following renders, in seconds
+        stale: number of compiled guile files found older than their source before rendering
+        recompiled: True if guile compiled any scheme code during the first render
+        repaired: True if the compiled files were repaired
+        log: the log of the first render
+    """
+    lilybin: Path
+    cold: float
+    warm: float
+    stale: int = 0
+    recompiled: bool = False
+    repaired: bool = False
+    log: str = ''
+
+
+_warmupsource = r"""
+\version "2.24.0"
+{ c'4 }
+"""
+
+
+def _autocompiled(log: str) -> bool:
+    """
+    True if the log shows that guile compiled (or wanted to compile) scheme code
+    """
+    return bool(re.search(r"^;;; (compiling|compiled|note: source file)", log, re.MULTILINE))
+
+
+def warmup(version='', runs=2) -> WarmupReport:
+    """
+    Check that an installation renders without recompiling, measure its latency
+
+    First the compiled guile files are checked against their sources and
+    repaired if needed (see :func:`check_ccache`). Then a trivial score is
+    rendered once (cold) and `runs` more times (warm). If guile compiled any
+    scheme code during the first render, the compiled files are repaired.
+
+    Meant to be run once after installing (for example, as a step when
+    building a container image), so that no later render pays for it
+
+    Args:
+        version: the version to warm up, as passed to :func:`lilypondbin`
+        runs: number of warm renders
+
+    Returns:
+        a :class:`WarmupReport`
+    """
+    lilybin = lilypondbin(version=version)
+    stale = check_ccache(version)
+    repaired = False
+    if stale:
+        logger.info(f"Found {len(stale)} stale compiled guile files, repairing")
+        repair_ccache(version)
+        repaired = True
+
+    t0 = time.time()
+    returncode, log, _ = _render_source(_warmupsource, fmt='pdf', lilybin=lilybin)
+    cold = time.time() - t0
+    if returncode != 0:
+        raise RenderError(f"Error rendering the warmup score, return code: {returncode}\n{log}",
+                          returncode=returncode, stderr=log)
+    recompiled = _autocompiled(log)
+    if recompiled:
+        logger.warning("Guile recompiled scheme code during the first render, repairing the compiled files")
+        repair_ccache(version)
+        repaired = True
+
+    warmtimes = []
+    for _ in range(runs):
+        t0 = time.time()
+        _, warmlog, _ = _render_source(_warmupsource, fmt='pdf', lilybin=lilybin)
+        warmtimes.append(time.time() - t0)
+        if _autocompiled(warmlog):
+            logger.warning(f"Guile still recompiles scheme code after repairing. Log:\n{warmlog}")
+    warm = min(warmtimes) if warmtimes else cold
+    logger.info(f"Warmup of {lilybin}: first render {cold:.3f}s, warm render {warm:.3f}s")
+    return WarmupReport(lilybin=lilybin, cold=cold, warm=warm, stale=len(stale),
+                        recompiled=recompiled, repaired=repaired, log=log)
@@ -0,0 +1,169 @@
+"""
+asyncio counterparts of the blocking functions of lilyponddist
+
+Lilypond processes are run as asyncio subprocesses. Installing runs in a
+worker thread, so that the event loop is never blocked while downloading
+and extracting
+"""
+from __future__ import annotations
+
+from pathlib import Path
+import asyncio
+import os
+import time
+import weakref
+
+from . import (LASTVERSION, _find_lilypond, _parse_version_output, _read_probe, _write_probe,
+               available_versions, install_lilypond, installed_versions, logger, prefetch)
+from ._render import RenderResult, _formatargs, _collect_outputs
+
+from typing import Sequence
+
+
+_versions: dict[Path, tuple[tuple[int, int, int], str]] = {}
+
+_limiters: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = weakref.WeakKeyDictionary()
+
+_maxconcurrency = 0
+
+
+def set_max_concurrency(n: int) -> None:
+    """
+    Set the max. number of lilypond processes run at the same time by :func:`arender`
+
+    Args:
+        n: the number of processes, 0 to use the number of cpus. This only
+            affects event loops which have not rendered anything yet
+    """
+    global _maxconcurrency
+    _maxconcurrency = n
+
+
+def _limiter() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limiter = _limiters[loop] = asyncio.Semaphore(_maxconcurrency or os.cpu_count() or 1)
+    return limiter
+
+
+async def ainstall_lilypond(version: tuple[int, int, int] | str = LASTVERSION,
+                            osname='',
+                            arch=''
+                            ) -> Path:
+    """
+    Async version of :func:`install_lilypond`
+
+    The download and extraction run in a worker thread. Concurrent
+    installations of the same version are serialized by the install lock
+
+    Args:
+        version: the version to download/install
+        osname: one of 'linux', 'windows', 'darwin'
+        arch: one of 'x86_64', 'arm64'.
+
+    Returns:
+        the destination folder
+    """
+    return await asyncio.to_thread(install_lilypond, version=version or LASTVERSION, osname=osname, arch=arch)
+
+
+async def alilypondbin(version='') -> Path:
+    """
+    Async version of :func:`lilypondbin`
+
+    Installs lilypond if needed, without blocking the event loop
+    """
+    if not installed_versions():
+        await asyncio.wrap_future(prefetch(version=version))
+    lily = _find_lilypond(version=version)
+    if not lily:
+        raise RuntimeError(f"Could not find lilypond binary for version '{version}'. "
+                           f"Installed versions: {installed_versions().keys()}, "
+                           f"available versions: {available_versions()}")
+    return lily
+
+
+async def alilypond_version(version='') -> tuple[tuple[int, int, int], str]:
+    """
+    Async version of :func:`lilypond_version`
+
+    Args:
+        version: the version to query, as passed to :func:`lilypondbin`. If
+            not given, the latest installed version is queried
+
+    Returns:
+        a tuple (version, versionline)
+    """
+    lilybin = _find_lilypond(version=version)
+    if not lilybin or not lilybin.exists():
+        raise RuntimeError("Lilypond has not been installed via lilyponddist")
+    if (cached := _versions.get(lilybin) or _read_probe(lilybin)) is not None:
+        return cached
+    proc = await asyncio.create_subprocess_exec(str(lilybin), '--version',
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        logger.error(stderr)
+        raise RuntimeError(f"Error while running '{lilybin} --version', error code: {proc.returncode}")
+    out = _versions[lilybin] = _parse_version_output(stdout.decode())
+    _write_probe(lilybin, out)
+    return out
+
+
+async def arender(path: str | Path,
+                  formats: Sequence[str] = ('pdf',),
+                  outdir: str | Path = '',
+                  version='',
+                  args: Sequence[str] = (),
+                  limiter: asyncio.Semaphore | None = None
+                  ) -> RenderResult:
+    """
+    Async version of :func:`render`
+
+    The number of lilypond processes running at the same time is limited
+    (see :func:`set_max_concurrency`). Jobs exceeding this limit wait
+    for a free slot
+
+    Args:
+        path: the .ly file to render
+        formats: the output formats, any of 'pdf', 'svg', 'png', 'ps'
+        outdir: the folder where to place the output. If not given, the
+            output is placed next to the source
+        version: the lilypond version to use, as passed to :func:`lilypondbin`
+        args: any other arguments passed to lilypond
+        limiter: a semaphore to limit concurrency, to be used instead of
+            the default limiter
+
+    Returns:
+        a :class:`RenderResult`
+
+    Example
+    ~~~~~~~
+
+    >>> results = await asyncio.gather(*(arender(path, formats=['svg']) for path in paths))
+    """
+    path = Path(path).absolute()
+    outfolder = Path(outdir).absolute() if outdir else path.parent
+    outfolder.mkdir(parents=True, exist_ok=True)
+    outbase = outfolder / path.stem
+    lilybin = await alilypondbin(version=version)
+    cmd = [str(lilybin), *_formatargs(formats), *args, '-o', str(outbase), str(path)]
+    async with (limiter or _limiter()):
+        logger.debug(f"Rendering '{path}': {cmd}")
+        t0 = time.time()
+        proc = await asyncio.create_subprocess_exec(*cmd,
+                                                    stdout=asyncio.subprocess.DEVNULL,
+                                                    stderr=asyncio.subprocess.PIPE,
+                                                    cwd=path.parent)
+        _, stderr = await proc.communicate()
+        elapsed = time.time() - t0
+    returncode = proc.returncode if proc.returncode is not None else -1
+    if returncode != 0:
+        logger.error(f"Error rendering '{path}', return code: {returncode}")
+    return RenderResult(source=path,
+                        returncode=returncode,
+                        stderr=stderr.decode(errors='replace'),
+                        outputs=_collect_outputs(outbase, formats, since=int(t0) - 1),
+                        elapsed=elapsed)
@@ -0,0 +1,288 @@
+"""
+Content-addressed cache of rendered outputs
+
+The key of an entry is a hash of everything which determines the output of
+lilypond: the source, the content of any included file, the lilypond version
+and the command line. A hit returns the stored outputs without running lilypond
+"""
+from __future__ import annotations
+
+from pathlib import Path
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from . import _lilyponddist_folder, _probe_version, logger
+
+from typing import Sequence
+
+
+_includeregex = re.compile(r'\\include\s+"([^"]+)"')
+
+# The part of an output's name after the output basename: the extension,
+# optionally preceded by a page number ('-2.svg', '-page2.png'). Only svg and
+# png are saved one file per page, '-2.pdf' is the output of another source
+_outputsuffix = re.compile(r"\.(pdf|ps)|(-(page)?[0-9]+)?\.(svg|png)")
+
+
+def _includepaths(args: Sequence[str]) -> list[Path]:
+    """
+    The include folders passed to lilypond via -I / --include
+    """
+    out = []
+    args = list(args)
+    for i, arg in enumerate(args):
+        if arg in ('-I', '--include') and i + 1 < len(args):
+            out.append(Path(args[i + 1]))
+        elif arg.startswith('--include='):
+            out.append(Path(arg.split('=', 1)[1]))
+        elif arg.startswith('-I') and len(arg) > 2:
+            out.append(Path(arg[2:]))
+    return out
+
+
+def resolve_includes(path: Path, includepaths: Sequence[Path] = ()) -> list[Path]:
+    """
+    All files included by path, recursively
+
+    Includes are searched relative to the including file, relative to
+    the main file and within the include paths. Includes which cannot be
+    found (for example, files distributed with lilypond itself, like
+    "english.ly") are skipped.
+
+    Args:
+        path: the main .ly file
+        includepaths: any include folders passed to lilypond
+
+    Returns:
+        a list of the included files, in the order in which they are found
+    """
+    path = Path(path).absolute()
+    seen = {path}
+    out = []
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            text = current.read_text(errors='replace')
+        except OSError:
+            continue
+        for name in _includeregex.findall(text):
+            for folder in (current.parent, path.parent, *includepaths):
+                candidate = (folder / name).absolute()
+                if candidate.is_file():
+                    if candidate not in seen:
+                        seen.add(candidate)
+                        out.append(candidate)
+                        stack.append(candidate)
+                    break
+    return out
+
+
+def cachekey(path: Path, lilybin: Path, args: Sequence[str]) -> str:
+    """
+    The cache key for rendering path with the given binary and arguments
+
+    Args:
+        path: the .ly file
+        lilybin: the lilypond binary
+        args: the complete list of arguments passed to lilypond, except
+            the source and the output (-o)
+
+    Returns:
+        the key, as a hex digest
+    """
+    h = hashlib.sha256()
+    h.update(_probe_version(lilybin)[1].encode())
+    h.update(b'\0'.join(arg.encode() for arg in args))
+    h.update(b'\0')
+    h.update(path.read_bytes())
+    for include in resolve_includes(path, includepaths=_includepaths(args)):
+        h.update(str(include).encode())
+        h.update(include.read_bytes())
+    return h.hexdigest()
+
+
+class RenderCache:
+    """
+    A cache of rendered outputs, bounded in size
+
+    Each entry is a folder holding the outputs of one render. When the
+    cache grows beyond `maxsize` bytes, the least recently used entries
+    are removed.
+
+    Entries are written to a temporary folder and moved into place with an
+    atomic rename, and removed by renaming them away before deleting them,
+    so the cache can be shared by many threads and processes.
+
+    The size of the cache is kept as a running total, so storing an entry
+    does not need to scan the cache. The cache is scanned when the total
+    exceeds maxsize, or after `rescan` seconds, to account for entries
+    stored by other processes
+
+    Args:
+        folder: the folder of the cache. If not given, a folder within the
+            lilyponddist folder is used
+        maxsize: max. size of the cache, in bytes
+        rescan: max. time in seconds between scans of the cache
+    """
+
+    def __init__(self, folder: str | Path = '', maxsize=2**30, rescan=60.):
+        self.folder = Path(folder) if folder else _lilyponddist_folder() / 'rendercache'
+        self.maxsize = maxsize
+        self.rescan = rescan
+        self._tmpfolder = self.folder / 'tmp'
+        # Running size of the cache, None until scanned
+        self._size: int | None = None
+        self._scantime = 0.
+        self._lock = threading.Lock()
+
+    def _entry(self, key: str) -> Path:
+        return self.folder / key[:2] / key
+
+    def get(self, key: str, outbase: Path) -> list[Path] | None:
+        """
+        Copy the outputs stored under key to outbase
+
+        Args:
+            key: the key as returned by :func:`cachekey`
+            outbase: the output basename. A stored output with the suffix
+                '.pdf' is copied to '<outbase>.pdf'
+
+        Returns:
+            the copied outputs, or None if key is not in the cache
+        """
+        entry = self._entry(key)
+        try:
+            names = sorted(os.listdir(entry))
+            # Mark as recently used
+            os.utime(entry)
+            outputs = []
+            for name in names:
+                dest = outbase.with_name(outbase.name + name)
+                shutil.copyfile(entry / name, dest)
+                outputs.append(dest)
+        except FileNotFoundError:
+            # Not present or evicted while reading
+            return None
+        logger.debug(f"Render cache hit: {key}")
+        return outputs
+
+    def put(self, key: str, outputs: Sequence[Path], outbase: Path) -> None:
+        """
+        Store outputs under key
+
+        Args:
+            key: the key as returned by :func:`cachekey`
+            outputs: the files generated by lilypond
+            outbase: the output basename used to render. Outputs are
+                stored relative to it
+        """
+        entry = self._entry(key)
+        if entry.exists():
+            return
+        self._tmpfolder.mkdir(parents=True, exist_ok=True)
+        tmp = self._tmpfolder / uuid.uuid4().hex
+        tmp.mkdir()
+        entrysize = 0
+        for output in outputs:
+            if not output.name.startswith(outbase.name):
+                raise ValueError(f"Output {output} does not match the output basename {outbase}")
+            suffix = output.name[len(outbase.name):]
+            if not _outputsuffix.fullmatch(suffix):
+                logger.debug(f"Render cache: {output} is not an output of {outbase}, not storing it")
+                continue
+            shutil.copyfile(output, tmp / suffix)
+            entrysize += os.path.getsize(tmp / suffix)
+        entry.parent.mkdir(exist_ok=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        with self._lock:
+            if self._size is not None and time.time() - self._scantime < self.rescan:
+                self._size += entrysize
+                if self._size <= self.maxsize:
+                    return
+        self.evict()
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        """
+        Returns a list of (last use, size, entry)
+        """
+        out = []
+        for prefix in os.scandir(self.folder):
+            if not prefix.is_dir() or prefix.name == 'tmp':
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    out.append((entry.stat().st_mtime, size, Path(entry.path)))
+                except FileNotFoundError:
+                    pass
+        return out
+
+    def size(self) -> int:
+        """The size of the cache, in bytes"""
+        if not self.folder.exists():
+            return 0
+        return sum(size for _, size, _ in self._entries())
+
+    def _remove(self, entry: Path) -> None:
+        tmp = self._tmpfolder / uuid.uuid4().hex
+        try:
+            os.rename(entry, tmp)
+        except OSError:
+            return
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries if the cache exceeds maxsize
+
+        Entries are removed until the cache uses 90% of maxsize
+        """
+        scantime = time.time()
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.maxsize:
+            # Leave some room, so that a full cache is not scanned at every put
+            target = self.maxsize * 0.9
+            entries.sort()
+            for _, size, entry in entries:
+                if total <= target:
+                    break
+                logger.debug(f"Render cache: evicting {entry.name}")
+                self._remove(entry)
+                total -= size
+        with self._lock:
+            self._size = total
+            self._scantime = scantime
+
+    def clear(self) -> None:
+        """Remove all entries"""
+        if self.folder.exists():
+            for _, _, entry in self._entries():
+                self._remove(entry)
+        with self._lock:
+            self._size = 0
+            self._scantime = time.time()
+
+
+_default: RenderCache | None = None
+
+
+def default_cache() -> RenderCache:
+    """
+    The cache used when rendering with cache=True
+    """
+    global _default
+    if _default is None:
+        _default = RenderCache()
+    return _default
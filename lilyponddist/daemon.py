@@ -0,0 +1,318 @@
+"""
+Long-lived lilypond processes, rendering one job after the other
+
+A :class:`RenderDaemon` starts lilypond once with a scheme driver loop which
+reads jobs from stdin and compiles each one within the same guile process.
+This saves the startup time of lilypond (loading guile and its compiled
+cache, fonts, etc.) for each job.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+import subprocess
+import threading
+import queue
+import time
+import concurrent.futures
+
+from . import lilypondbin, logger
+from ._render import RenderResult, _formatargs, _collect_outputs
+
+from typing import Iterator, Sequence
+
+
+_donemarker = "@@lilyponddist-done"
+
+
+# The driver loop follows what lilypond itself does between files
+# in `lilypond-all` (lily.scm): parse, terminate the session, restore the
+# options and collect garbage. Each job is read as a list ("file.ly" "outdir")
+# and answered in the log with a line "@@lilyponddist-done <status>"
+_driver = """
+(let ((call-lily (lambda (name . args)
+                   (let ((proc (module-ref (resolve-module '(lily)) name #f)))
+                     (if (procedure? proc) (apply proc args)))))
+      (errport (current-error-port)))
+  (let loop ((job (read (current-input-port))))
+    (if (not (eof-object? job))
+        (let ((file (car job))
+              (outdir (cadr job))
+              (settings (ly:all-options))
+              (status 0))
+          (chdir outdir)
+          (catch #t
+            (lambda () (ly:parse-file file))
+            (lambda (key . args)
+              (set! status 1)
+              (format errport "~a: ~s ~s~%" file key args)))
+          (catch #t
+            (lambda ()
+              (call-lily 'ly:check-expected-warnings)
+              (call-lily 'session-terminate))
+            (lambda (key . args) #f))
+          (for-each (lambda (s) (ly:set-option (car s) (cdr s))) settings)
+          (gc)
+          (format errport "~%@@lilyponddist-done ~a~%" status)
+          (force-output errport)
+          (loop (read (current-input-port)))))))
+(exit 0)
+"""
+
+
+def _schemestr(s: str) -> str:
+    s = s.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{s}"'
+
+
+class RenderDaemon:
+    """
+    A lilypond process which renders jobs sent to it, one after the other
+
+    The process is started lazily, at the first job. It is recycled after
+    `maxjobs` jobs, after a crash or if a job does not finish within
+    `timeout` seconds.
+
+    The output formats and any extra arguments are fixed for the lifetime
+    of the daemon, since lilypond only reads them at startup.
+
+    Args:
+        formats: the output formats, any of 'pdf', 'svg', 'png', 'ps'
+        version: the lilypond version to use, as passed to :func:`lilypondbin`
+        maxjobs: number of jobs after which the process is restarted
+        timeout: max. time in seconds a job can take. 0 to wait indefinitely
+        args: any other arguments passed to lilypond at startup
+        lilybin: the lilypond binary to use. If given, version is ignored
+
+    Example
+    ~~~~~~~
+
+    >>> with RenderDaemon(formats=['svg']) as daemon:
+    ...     for path in paths:
+    ...         result = daemon.render(path, outdir='out')
+    """
+
+    def __init__(self,
+                 formats: Sequence[str] = ('pdf',),
+                 version='',
+                 maxjobs=200,
+                 timeout=0.,
+                 args: Sequence[str] = (),
+                 lilybin: Path | None = None):
+        self.formats = list(formats)
+        self.maxjobs = maxjobs
+        self.timeout = timeout
+        self.args = list(args)
+        self.lilybin = lilybin or lilypondbin(version=version)
+        self.jobcount = 0
+        self._formatargs = _formatargs(formats)
+        self._proc: subprocess.Popen | None = None
+        self._lines: queue.Queue[str | None] = queue.Queue()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_proc', None) is not None:
+            self.close()
+
+    def running(self) -> bool:
+        """True if the lilypond process is running"""
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self) -> None:
+        """
+        Start the lilypond process, if not running already
+        """
+        if self.running():
+            return
+        self.close()
+        cmd = [str(self.lilybin), *self._formatargs, *self.args, '-e', _driver]
+        logger.debug(f"Starting lilypond daemon: {self.lilybin}")
+        proc = subprocess.Popen(cmd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                text=True,
+                                errors='replace')
+        lines: queue.Queue[str | None] = queue.Queue()
+
+        def reader(stream, lines=lines):
+            for line in stream:
+                lines.put(line)
+            lines.put(None)
+
+        threading.Thread(target=reader, args=(proc.stderr,), daemon=True).start()
+        self._proc = proc
+        self._lines = lines
+        self.jobcount = 0
+
+    def close(self) -> None:
+        """
+        Stop the lilypond process
+        """
+        proc = self._proc
+        if proc is None:
+            return
+        self._proc = None
+        if proc.poll() is None:
+            try:
+                assert proc.stdin is not None
+                proc.stdin.close()
+                proc.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                proc.kill()
+                proc.wait()
+
+    def render(self, path: str | Path, outdir: str | Path = '') -> RenderResult:
+        """
+        Render a .ly file
+
+        Args:
+            path: the .ly file to render
+            outdir: the folder where to place the output. If not given, the
+                output is placed next to the source
+
+        Returns:
+            a :class:`RenderResult`
+        """
+        path = Path(path).absolute()
+        outfolder = Path(outdir).absolute() if outdir else path.parent
+        outfolder.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            if self.jobcount >= self.maxjobs:
+                logger.debug(f"Lilypond daemon rendered {self.jobcount} jobs, restarting")
+                self.close()
+            self.start()
+            proc = self._proc
+            assert proc is not None and proc.stdin is not None
+            t0 = time.time()
+            try:
+                proc.stdin.write(f"({_schemestr(str(path))} {_schemestr(str(outfolder))})\n")
+                proc.stdin.flush()
+            except OSError as e:
+                logger.error(f"Could not send job to lilypond daemon: {e}")
+            self.jobcount += 1
+            returncode, log = self._wait(proc)
+            elapsed = time.time() - t0
+        if returncode != 0:
+            logger.error(f"Error rendering '{path}', return code: {returncode}")
+        return RenderResult(source=path,
+                            returncode=returncode,
+                            stderr=log,
+                            outputs=_collect_outputs(outfolder / path.stem, self.formats, since=int(t0) - 1),
+                            elapsed=elapsed)
+
+    def _wait(self, proc: subprocess.Popen) -> tuple[int, str]:
+        """
+        Collect the log of the current job until it is done
+
+        Returns:
+            a tuple (returncode, log)
+        """
+        loglines = []
+        deadline = time.time() + self.timeout if self.timeout > 0 else 0
+        while True:
+            try:
+                line = self._lines.get(timeout=max(deadline - time.time(), 0.001) if deadline else None)
+            except queue.Empty:
+                logger.error(f"Lilypond daemon timed out after {self.timeout} seconds, killing it")
+                proc.kill()
+                self.close()
+                return -1, ''.join(loglines)
+            if line is None:
+                returncode = proc.wait()
+                logger.error(f"Lilypond daemon exited unexpectedly, return code: {returncode}")
+                self.close()
+                return returncode or -1, ''.join(loglines)
+            if line.startswith(_donemarker):
+                status = int(line.split()[1])
+                # Remove the empty line preceding the marker
+                if loglines and loglines[-1] == '\n':
+                    loglines.pop()
+                return status, ''.join(loglines)
+            loglines.append(line)
+
+
+class RenderDaemonPool:
+    """
+    A pool of :class:`RenderDaemon`
+
+    Jobs are dispatched to whichever daemon is idle. All daemons share the
+    same formats and arguments
+
+    Args:
+        size: number of daemons. Each daemon is a lilypond process
+        formats: the output formats, any of 'pdf', 'svg', 'png', 'ps'
+        version: the lilypond version to use, as passed to :func:`lilypondbin`
+        maxjobs: number of jobs after which a daemon is restarted
+        timeout: max. time in seconds a job can take. 0 to wait indefinitely
+        args: any other arguments passed to lilypond at startup
+
+    Example
+    ~~~~~~~
+
+    >>> pool = RenderDaemonPool(size=4, formats=['svg'])
+    >>> for result in pool.render_many(paths, outdir='out'):
+    ...     print(result.source, result.ok)
+    >>> pool.close()
+    """
+
+    def __init__(self,
+                 size=2,
+                 formats: Sequence[str] = ('pdf',),
+                 version='',
+                 maxjobs=200,
+                 timeout=0.,
+                 args: Sequence[str] = ()):
+        if size < 1:
+            raise ValueError(f"The size of the pool must be >= 1, got {size}")
+        lilybin = lilypondbin(version=version)
+        self.daemons = [RenderDaemon(formats=formats, maxjobs=maxjobs, timeout=timeout, args=args, lilybin=lilybin)
+                        for _ in range(size)]
+        self._idle: queue.Queue[RenderDaemon] = queue.Queue()
+        for daemon in self.daemons:
+            self._idle.put(daemon)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self) -> None:
+        """Start all daemons, to avoid paying the startup cost at the first jobs"""
+        for daemon in self.daemons:
+            daemon.start()
+
+    def close(self) -> None:
+        """Stop all daemons"""
+        for daemon in self.daemons:
+            daemon.close()
+
+    def render(self, path: str | Path, outdir: str | Path = '') -> RenderResult:
+        """
+        Render a .ly file using the first idle daemon
+
+        This blocks until a daemon is available. It can be called from
+        multiple threads
+        """
+        daemon = self._idle.get()
+        try:
+            return daemon.render(path, outdir=outdir)
+        finally:
+            self._idle.put(daemon)
+
+    def render_many(self, paths: Sequence[str | Path], outdir: str | Path = '') -> Iterator[RenderResult]:
+        """
+        Render many .ly files, yielding the results as they finish
+        """
+        if not paths:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.daemons)) as executor:
+            futures = [executor.submit(self.render, path, outdir=outdir) for path in paths]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
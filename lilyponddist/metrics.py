@@ -0,0 +1,149 @@
+"""
+Timing of the phases of installs and renders
+
+Installing and rendering emit an :class:`Event` for each phase they go
+through. Events can be received as they happen via :func:`add_listener`.
+They are also aggregated into counters, which :func:`get_metrics` returns
+as a flat dict using the naming conventions of prometheus
+
+Events emitted:
+
+* 'download': downloading an archive. Values: 'bytes', 'throughput' (bytes/s).
+  When the archive is extracted while being downloaded, the time waiting
+  for the network is counted as download and the rest as extract
+* 'extract': extracting an archive. Labels: 'format'
+* 'fixtimes': fixing the times of the compiled guile files. Values: 'files'
+* 'install': a whole installation. Labels: 'version', 'profile'
+* 'render': a render by :func:`render` or :func:`render_many`. Labels: 'status'
+  ('ok', 'error' or 'cached')
+* 'render_phase': a phase of a render, as found in the log of lilypond.
+  Labels: 'phase', one of 'startup', 'parsing', 'interpreting',
+  'preprocessing', 'layout', 'output'
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import threading
+
+from typing import Callable
+
+
+@dataclass
+class Event:
+    """
+    A timed phase of an install or a render
+
+    Attributes:
+        name: the kind of event, like 'download' or 'render_phase'
+        duration: the duration of the phase, in seconds
+        labels: any properties of the event, like {'phase': 'layout'}
+        values: any quantities measured, like {'bytes': 1234}
+    """
+    name: str
+    duration: float
+    labels: dict[str, str] = field(default_factory=dict)
+    values: dict[str, float] = field(default_factory=dict)
+
+
+_listeners: list[Callable[[Event], None]] = []
+
+# (name, labels) -> {'count': ..., 'seconds': ..., <value>: ...}
+_totals: dict[tuple[str, tuple[tuple[str, str], ...]], dict[str, float]] = {}
+
+_lock = threading.Lock()
+
+# Values which are rates, these are not summed
+_rates = {'throughput'}
+
+
+def add_listener(callback: Callable[[Event], None]) -> None:
+    """
+    Call callback with each :class:`Event` emitted
+
+    The callback is called from the thread doing the work, so it should
+    return quickly. Exceptions raised by it are ignored
+
+    Example
+    ~~~~~~~
+
+    >>> def show(event):
+    ...     print(event.name, event.labels, f"{event.duration:.3f}s")
+    >>> add_listener(show)
+    >>> render('score.ly')
+    render_phase {'phase': 'startup'} 0.412s
+    render_phase {'phase': 'parsing'} 0.050s
+    ...
+    """
+    with _lock:
+        _listeners.append(callback)
+
+
+def remove_listener(callback: Callable[[Event], None]) -> None:
+    """Stop calling callback, as added by :func:`add_listener`"""
+    with _lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+
+def _emit(name: str, duration: float, labels: dict[str, str] | None = None, **values: float) -> None:
+    event = Event(name=name, duration=duration, labels=labels or {}, values=values)
+    key = (name, tuple(sorted(event.labels.items())))
+    with _lock:
+        totals = _totals.get(key)
+        if totals is None:
+            totals = _totals[key] = {'count': 0, 'seconds': 0.}
+        totals['count'] += 1
+        totals['seconds'] += duration
+        for valuename, value in values.items():
+            if valuename not in _rates:
+                totals[valuename] = totals.get(valuename, 0) + value
+        listeners = list(_listeners)
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception as e:
+            from . import logger
+            logger.debug(f"Error in metrics listener {listener}: {e}")
+
+
+def get_metrics() -> dict[str, float]:
+    """
+    The totals of all events emitted so far
+
+    Each kind of event is reported as the number of events, the seconds
+    spent and the total of each value, with the labels of the event in
+    prometheus notation. Rates (like the download throughput) are not
+    aggregated, they can be computed from the totals
+
+    Returns:
+        a dict mapping metric name to its value
+
+    Example
+    ~~~~~~~
+
+    >>> get_metrics()
+    {'lilyponddist_download_seconds_count': 1,
+     'lilyponddist_download_seconds_sum': 12.5,
+     'lilyponddist_download_bytes_total': 118391862,
+     'lilyponddist_render_phase_seconds_sum{phase="layout"}': 3.25,
+     ...}
+    >>> # Prometheus text format
+    >>> print("\\n".join(f"{name} {value}" for name, value in get_metrics().items()))
+    """
+    out: dict[str, float] = {}
+    with _lock:
+        items = [(key, dict(totals)) for key, totals in _totals.items()]
+    for (name, labels), totals in sorted(items):
+        labelstr = ','.join(f'{k}="{v}"' for k, v in labels)
+        suffix = f"{{{labelstr}}}" if labelstr else ''
+        out[f"lilyponddist_{name}_seconds_count{suffix}"] = totals.pop('count')
+        out[f"lilyponddist_{name}_seconds_sum{suffix}"] = totals.pop('seconds')
+        for valuename, value in totals.items():
+            out[f"lilyponddist_{name}_{valuename}_total{suffix}"] = value
+    return out
+
+
+def reset_metrics() -> None:
+    """Reset the totals returned by :func:`get_metrics`"""
+    with _lock:
+        _totals.clear()
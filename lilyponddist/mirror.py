@@ -0,0 +1,77 @@
+"""
+Create and update a mirror of the lilypond release archives
+
+A mirror is a folder holding the archives of the versions and platforms
+needed, together with a file 'SHA256SUMS'. It can be used locally or served
+via http and is used for installing by calling :func:`set_mirror`
+"""
+from __future__ import annotations
+
+from pathlib import Path
+import os
+
+from . import (_download, _parse_checksums, _parse_versionstr, _sha256sum, _urlentry, _urls,
+               available_versions, get_platform_id, logger)
+
+from typing import Sequence
+
+
+def sync_mirror(folder: str | Path,
+                platforms: Sequence[str] = (),
+                versions: Sequence[str] = (),
+                showprogress=True
+                ) -> list[Path]:
+    """
+    Download the release archives to a mirror folder
+
+    Archives already present in the mirror and matching their digest are
+    not downloaded again. The file 'SHA256SUMS' of the mirror is updated.
+    Archives are verified against the digests known to this package, if any
+
+    Args:
+        folder: the mirror folder. It is created if needed
+        platforms: the platforms to mirror, like 'linux-x86_64' (see
+            :func:`get_platform_id`). If not given, the current platform
+        versions: the versions to mirror. If not given, all available versions
+        showprogress: show a progress bar while downloading
+
+    Returns:
+        the archives in the mirror for the given platforms and versions
+
+    Example
+    ~~~~~~~
+
+    >>> sync_mirror('/srv/lilypond-mirror', platforms=['linux-x86_64', 'windows-x86_64'])
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    platforms = list(platforms) or [get_platform_id()]
+    wanted = {_parse_versionstr(v) for v in versions}
+    sumspath = folder / 'SHA256SUMS'
+    sums = _parse_checksums(sumspath.read_text()) if sumspath.exists() else {}
+    out = []
+    for versionstr, versionplatforms in available_versions():
+        versiontup = _parse_versionstr(versionstr)
+        if wanted and versiontup not in wanted:
+            continue
+        for platform in platforms:
+            if platform not in versionplatforms:
+                logger.info(f"Version {versionstr} is not available for {platform}")
+                continue
+            osname, arch = platform.split('-', 1)
+            url, sha256 = _urlentry(_urls[versiontup][(osname, arch)])
+            name = os.path.split(url)[1]
+            dest = folder / name
+            known = sha256 or sums.get(name, '')
+            if dest.exists() and known and _sha256sum(dest) == known:
+                logger.debug(f"'{name}' is up to date")
+                sums[name] = known
+            else:
+                # Without a digest an existing archive is only checked for its size
+                _download(url, folder, showprogress=showprogress, skip=not known, sha256=sha256)
+                sums[name] = sha256 or _sha256sum(dest)
+            out.append(dest)
+            tmp = sumspath.with_name(sumspath.name + '.tmp')
+            tmp.write_text(''.join(f"{digest}  {filename}\n" for filename, digest in sorted(sums.items())))
+            os.replace(tmp, sumspath)
+    return out
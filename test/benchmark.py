@@ -0,0 +1,364 @@
+"""
+Benchmarks of lilyponddist, with results as json
+
+Sections:
+
+* import: cold (no bytecode cache) and warm `import lilyponddist`
+* lookup: installed_versions() and lilypondbin() with many versions installed
+* extract: installing synthetic archives served by a local http server
+* render: throughput and latency percentiles of rendering a corpus of
+  small and large files, for different numbers of workers. Needs lilypond
+  installed, or a binary given via --lilybin
+
+Each section which needs an installation runs in a subprocess with its own
+data folder, so the benchmark never touches the real installation.
+
+Times are reported in seconds (keys ending in '_s'), rates per second
+(keys ending in '_per_s'). With --compare, the results are compared to
+a previous run and the script fails if any of them is worse than the
+given tolerance
+
+Example::
+
+    python test/benchmark.py --output baseline.json
+    # ... later
+    python test/benchmark.py --output new.json --compare baseline.json --tolerance 0.25
+"""
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import functools
+import http.server
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+root = Path(__file__).parent.parent
+sys.path.insert(0, str(root))
+
+sections = ['import', 'lookup', 'extract', 'render']
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--only', default=','.join(sections), help='Comma separated list of sections to run')
+parser.add_argument('--runs', type=int, default=5, help='Number of runs of each measurement')
+parser.add_argument('--versions', type=int, default=50, help='Number of versions installed for the lookup benchmark')
+parser.add_argument('--files', type=int, default=2000, help='Number of files of the synthetic archives')
+parser.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4])
+parser.add_argument('--corpus', help='A folder with .ly files to render. If not given, a synthetic corpus is used')
+parser.add_argument('--corpus-size', type=int, default=12, help='Number of files of the synthetic corpus')
+parser.add_argument('--lilybin', help='The lilypond binary used for rendering, defaults to the installed one')
+parser.add_argument('--output', help='Save the results to this file. If not given, they are printed to stdout')
+parser.add_argument('--compare', help='Results of a previous run to compare to')
+parser.add_argument('--tolerance', type=float, default=0.2,
+                    help='Max. relative regression allowed when comparing, 0.2 = 20%%')
+args = parser.parse_args()
+
+
+def log(msg: str) -> None:
+    print(msg, file=sys.stderr)
+
+
+def runpython(code: str, env: dict | None = None) -> dict:
+    """
+    Run code in a fresh interpreter, returns the json it prints as its last line
+
+    Variables set to None in env are removed from the environment
+    """
+    fullenv = {**os.environ, 'PYTHONPATH': str(root), **(env or {})}
+    fullenv = {key: value for key, value in fullenv.items() if value is not None}
+    proc = subprocess.run([sys.executable, '-c', code], env=fullenv, capture_output=True, text=True, cwd=root)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Benchmark subprocess failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def summary(times: list) -> dict:
+    return {'min_s': min(times), 'median_s': statistics.median(times)}
+
+
+def bench_import() -> dict:
+    code = ("import time, json; t0 = time.perf_counter(); import lilyponddist; "
+            "print(json.dumps(time.perf_counter() - t0))")
+    cold, warm = [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as pycache:
+            # An empty bytecode cache: every module is compiled again. The
+            # second run finds the cache written by the first one
+            env = {'PYTHONPYCACHEPREFIX': pycache, 'PYTHONDONTWRITEBYTECODE': None}
+            cold.append(runpython(code, env=env))
+            warm.append(runpython(code, env=env))
+    return {'cold': summary(cold), 'warm': summary(warm)}
+
+
+_lookupcode = """
+import json, time
+import lilyponddist
+from lilyponddist import installed_versions, lilypondbin
+def timed(func, n=1):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        func()
+    return (time.perf_counter() - t0) / n
+out = {'first_s': timed(installed_versions)}
+out['cached_s'] = timed(installed_versions, 1000)
+lilyponddist._reset_cache()
+out['uncached_s'] = timed(installed_versions)
+out['lilypondbin_s'] = timed(lambda: lilypondbin(version=VERSION), 1000)
+print(json.dumps(out))
+"""
+
+
+def bench_lookup(tmp: Path) -> dict:
+    data = tmp / 'lookup'
+    base = data / 'lilyponddist'
+    exe = 'lilypond.exe' if sys.platform == 'win32' else 'lilypond'
+    versions = [f"2.{20 + i // 20}.{i % 20}" for i in range(args.versions)]
+    for version in versions:
+        bindir = base / f"lilypond-{version}" / 'bin'
+        bindir.mkdir(parents=True)
+        (bindir / exe).write_text('')
+    env = {'LILYPONDDIST_DATA': str(base)}
+    code = _lookupcode.replace('VERSION', repr(versions[len(versions) // 2]))
+    runs = [runpython(code, env=env) for _ in range(args.runs + 1)]
+    # The first run has no index yet and scans the folder
+    out = {'versions': len(versions), 'noindex_s': runs[0]['first_s']}
+    for key in ('first_s', 'cached_s', 'uncached_s', 'lilypondbin_s'):
+        out[key.replace('first', 'indexed')] = statistics.median(run[key] for run in runs[1:])
+    return out
+
+
+def synthetic_tree(numfiles: int) -> list:
+    """
+    (relpath, content) pairs resembling a lilypond installation
+    """
+    words = [f"word{i}".encode() for i in range(300)]
+    out = [('bin/lilypond', b'#!/bin/sh\n')]
+    for i in range(numfiles):
+        size = 2**20 if i % 400 == 0 else 500 + (i * 7919) % 30000
+        content = b' '.join(words[(i * j) % 300] for j in range(size // 6))
+        if i % 4 == 0:
+            out.append((f"lib/lilypond/9.9.9/ccache/lily/file{i}.go", content))
+        else:
+            out.append((f"share/lilypond/9.9.9/scm/{i % 50}/file{i}.scm", content))
+    return out
+
+
+def write_archives(folder: Path, numfiles: int) -> dict:
+    tree = synthetic_tree(numfiles)
+    prefix = 'lilypond-9.9.9/'
+    targz = folder / 'lilypond-9.9.9-linux-x86_64.tar.gz'
+    with tarfile.open(targz, 'w:gz') as tfile:
+        for relpath, content in tree:
+            info = tarfile.TarInfo(prefix + relpath)
+            info.size = len(content)
+            info.mode = 0o755
+            tfile.addfile(info, io.BytesIO(content))
+    zippath = folder / 'lilypond-9.9.9-mingw-x86_64.zip'
+    with zipfile.ZipFile(zippath, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        for relpath, content in tree:
+            z.writestr(prefix + relpath, content)
+    return {'tar.gz': targz, 'zip': zippath,
+            'uncompressed_bytes': sum(len(content) for _, content in tree)}
+
+
+_extractcode = """
+import json, time
+import lilyponddist
+lilyponddist.logger.setLevel('WARNING')
+osname, arch = lilyponddist.get_platform()
+lilyponddist._urls[(9, 9, 9)] = {(osname, arch): URL}
+t0 = time.perf_counter()
+lilyponddist.install_lilypond('9.9.9', stream=STREAM, force=True)
+elapsed = time.perf_counter() - t0
+metrics = lilyponddist.get_metrics()
+def phase(name):
+    return sum(v for k, v in metrics.items() if k.startswith(f'lilyponddist_{name}_seconds_sum'))
+print(json.dumps({'total_s': elapsed, 'download_s': phase('download'), 'extract_s': phase('extract'),
+                  'fixtimes_s': phase('fixtimes')}))
+"""
+
+
+def bench_extract(tmp: Path) -> dict:
+    served = tmp / 'served'
+    served.mkdir()
+    archives = write_archives(served, args.files)
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    handler = functools.partial(Handler, directory=str(served))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    out = {'files': args.files, 'uncompressed_bytes': archives['uncompressed_bytes']}
+    cases = [('targz_stream', archives['tar.gz'], True),
+             ('targz_download', archives['tar.gz'], False),
+             ('zip', archives['zip'], False)]
+    try:
+        for name, archive, stream in cases:
+            url = f"http://127.0.0.1:{server.server_address[1]}/{archive.name}"
+            code = _extractcode.replace('URL', repr(url)).replace('STREAM', repr(stream))
+            runs = []
+            for i in range(args.runs):
+                data = tmp / f"extract-{name}-{i}"
+                with tempfile.TemporaryDirectory(dir=tmp) as tempdir:
+                    # The downloaded archive goes to the temp folder, it must not be reused
+                    runs.append(runpython(code, env={'LILYPONDDIST_DATA': str(data / 'lilyponddist'),
+                                                     'TMPDIR': tempdir}))
+                shutil.rmtree(data, ignore_errors=True)
+            out[name] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+            out[name]['throughput_bytes_per_s'] = archives['uncompressed_bytes'] / out[name]['total_s']
+    finally:
+        server.shutdown()
+    return out
+
+
+def synthetic_corpus(folder: Path, size: int) -> list:
+    small = '\\version "2.24.0"\n{ c\'4 d\'4 e\'4 f\'4 }\n'
+    bar = "c'8 d' e' f' g' a' b' c'' | "
+    large = '\\version "2.24.0"\n\\score { \\new PianoStaff << \\new Staff { ' + bar * 400 + \
+            ' } \\new Staff { \\clef bass ' + bar.replace("'", ",") * 400 + ' } >> }\n'
+    paths = []
+    for i in range(size):
+        path = folder / f"{'large' if i % 4 == 3 else 'small'}{i}.ly"
+        path.write_text(large if i % 4 == 3 else small)
+        paths.append(path)
+    return paths
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    lo, hi = int(pos), min(int(pos) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def bench_render(tmp: Path) -> dict:
+    import lilyponddist
+    from lilyponddist import render
+    if args.lilybin:
+        lilybin = Path(args.lilybin)
+    elif lilyponddist.is_lilypond_installed():
+        lilybin = lilyponddist.lilypondbin()
+    else:
+        return {'skipped': 'lilypond is not installed, use --lilybin'}
+    lilyponddist.logger.setLevel('WARNING')
+    if args.corpus:
+        paths = sorted(Path(args.corpus).glob('*.ly'))
+    else:
+        corpus = tmp / 'corpus'
+        corpus.mkdir()
+        paths = synthetic_corpus(corpus, args.corpus_size)
+    out = {'lilybin': str(lilybin), 'files': len(paths)}
+    # Once, so that the first measurement does not pay for a cold cache
+    render(paths[0], outdir=tmp / 'out', lilybin=lilybin)
+    for workers in args.workers:
+        latencies = []
+        phases: dict = {}
+        failed = 0
+        t0 = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(lambda path: render(path, outdir=tmp / 'out', lilybin=lilybin), paths):
+                latencies.append(result.elapsed)
+                failed += not result.ok
+                for phase, duration in result.phases.items():
+                    phases[phase] = phases.get(phase, 0.) + duration
+        wall = time.perf_counter() - t0
+        out[f"workers{workers}"] = {
+            'wall_s': wall,
+            'throughput_files_per_s': len(paths) / wall,
+            'p50_s': percentile(latencies, 0.5),
+            'p90_s': percentile(latencies, 0.9),
+            'p99_s': percentile(latencies, 0.99),
+            'phases_mean_s': {phase: total / len(paths) for phase, total in phases.items()},
+            'failed': failed
+        }
+    return out
+
+
+def flatten(d: dict, prefix='') -> dict:
+    out = {}
+    for key, value in d.items():
+        if isinstance(value, dict):
+            out.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            out[f"{prefix}{key}"] = value
+    return out
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Returns a list of (key, old, new) for each result worse than the baseline
+    """
+    new, old = flatten(results), flatten(baseline)
+    regressions = []
+    for key, value in new.items():
+        if key not in old or not old[key] or '.phases_mean_s.' in key:
+            continue
+        if key.endswith('_per_s'):
+            worse = value < old[key] * (1 - tolerance)
+        elif key.endswith('_s'):
+            worse = value > old[key] * (1 + tolerance)
+        else:
+            continue
+        if worse:
+            regressions.append((key, old[key], value))
+    return regressions
+
+
+def main() -> int:
+    benchmarks = {
+        'import': lambda tmp: bench_import(),
+        'lookup': bench_lookup,
+        'extract': bench_extract,
+        'render': bench_render
+    }
+    only = args.only.split(',')
+    if unknown := [name for name in only if name not in benchmarks]:
+        parser.error(f"Unknown sections {unknown}, possible sections: {sections}")
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='lilyponddist-bench-') as tmpfolder:
+        for name in only:
+            log(f"Running '{name}'")
+            t0 = time.perf_counter()
+            results[name] = benchmarks[name](Path(tmpfolder))
+            log(f"   ... done in {time.perf_counter() - t0:.1f} s")
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'runs': args.runs
+        },
+        'results': results
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for key, old, new in regressions:
+            log(f"Regression: {key}: {old:.6g} -> {new:.6g}")
+        if regressions:
+            return 1
+        log(f"No regressions beyond {args.tolerance:.0%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
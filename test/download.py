@@ -0,0 +1,119 @@
+"""
+Checks the resumable, multi-connection download against a local server
+
+The server supports range requests and can be told to reject HEAD requests
+or to drop connections midway, to exercise the fallback to a single GET and
+the resuming of interrupted segments
+"""
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import lilyponddist
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=int, default=3 * 2**20 + 12345, help='Size of the file served, in bytes')
+args = parser.parse_args()
+
+payload = os.urandom(args.size)
+digest = hashlib.sha256(payload).hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Set by each check
+    rejecthead = False
+    dropafter = 0       # drop the first connections after sending this many bytes
+    drops = 0           # ... this many times
+    requests: list = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        if self.rejecthead:
+            self.send_error(405)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        start, end = 0, len(payload) - 1
+        if match := re.fullmatch(r"bytes=([0-9]+)-([0-9]*)", self.headers.get('Range', '')):
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+        Handler.requests.append((self.command, start, end))
+        data = payload[start:end + 1]
+        self.send_response(206 if 'Range' in self.headers else 200)
+        self.send_header('Content-Length', str(len(data)))
+        if 'Range' in self.headers:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(payload)}")
+        self.end_headers()
+        with lock:
+            drop = Handler.drops > 0 and len(data) > Handler.dropafter
+            if drop:
+                Handler.drops -= 1
+        if drop:
+            self.wfile.write(data[:Handler.dropafter])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(data)
+
+
+lock = threading.Lock()
+server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = f"http://127.0.0.1:{server.server_address[1]}/lilypond-9.9.9.tar.gz"
+tmp = Path(tempfile.mkdtemp(prefix='lilyponddist-download-'))
+failed = []
+
+
+def check(name: str, rejecthead=False, dropafter=0, drops=0, sha256=digest, parts: dict = {}, expect=None,
+          mustfail=False):
+    Handler.rejecthead, Handler.dropafter, Handler.drops, Handler.requests = rejecthead, dropafter, drops, []
+    folder = tmp / name
+    folder.mkdir()
+    for partname, numbytes in parts.items():
+        (folder / partname).write_bytes(payload[:numbytes])
+    try:
+        dest = lilyponddist._download(url, folder, showprogress=False, sha256=sha256, connections=4)
+        ok = dest.read_bytes() == payload and not list(folder.glob('*.part*'))
+        ok = ok and not mustfail and (expect is None or expect(Handler.requests))
+    except OSError as e:
+        print(f"{name}: {e}")
+        # A failed download leaves no file behind
+        ok = mustfail and not list(folder.iterdir())
+    print(f"{name:<12} {'ok' if ok else 'FAILED'}  requests: {Handler.requests}")
+    if not ok:
+        failed.append(name)
+
+
+try:
+    # Four segments, each fetched with one range request
+    check('ranges')
+    # Interrupted segments are resumed from where they stopped
+    check('interrupted', dropafter=100000, drops=3,
+          expect=lambda requests: len(requests) == 7)
+    # Part files left by a previous call are continued, not downloaded again
+    check('resume', parts={'lilypond-9.9.9.tar.gz.part0of4': 50000},
+          expect=lambda requests: ('GET', 50000, -(-args.size // 4) - 1) in requests)
+    # A server rejecting HEAD is downloaded with a single GET
+    check('nohead', rejecthead=True, expect=lambda requests: requests == [('GET', 0, args.size - 1)])
+    check('badsum', sha256='0' * 64, mustfail=True)
+finally:
+    server.shutdown()
+    shutil.rmtree(tmp)
+
+if failed:
+    print(f"Failed: {failed}")
+    sys.exit(1)
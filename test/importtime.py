@@ -0,0 +1,47 @@
+"""
+Checks that `import lilyponddist` stays cheap
+
+Fails if importing lilyponddist pulls in any of the modules only needed
+for installing or rendering, if it takes longer than the given budget, or
+if a public name imported lazily is replaced by a submodule of the same name
+"""
+import argparse
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--budget', type=float, default=100, help='Max. import time, in milliseconds')
+parser.add_argument('--runs', type=int, default=5)
+args = parser.parse_args()
+
+lazymodules = ['urllib.request', 'tempfile', 'progressbar', 'subprocess', 'sysconfig', 'hashlib',
+               'tarfile', 'zipfile', 'asyncio', 'concurrent.futures', 'shutil', 'uuid']
+
+code = "import sys; import lilyponddist; print(' '.join(sys.modules))"
+loaded = set(subprocess.check_output([sys.executable, '-c', code], text=True).split())
+eager = [name for name in lazymodules if name in loaded]
+
+times = []
+for _ in range(args.runs):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import lilyponddist'],
+                          capture_output=True, text=True, check=True)
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == 'lilyponddist':
+            times.append(int(parts[1]) / 1000)
+
+# Names imported lazily must survive the import of their submodule, which
+# sets the attribute with the name of the submodule on the package
+code = ("import lilyponddist; lilyponddist.render_many; lilyponddist.warmup; lilyponddist.build; "
+        "print(' '.join(name for name in ('render', 'render_many', 'build', 'warmup') "
+        "if not callable(getattr(lilyponddist, name))))")
+shadowed = subprocess.check_output([sys.executable, '-c', code], text=True).split()
+
+importtime = min(times)
+print(f"import lilyponddist: {importtime:.1f} ms (budget: {args.budget} ms)")
+if eager:
+    print(f"Modules imported eagerly: {eager}")
+if shadowed:
+    print(f"Public names replaced by a submodule: {shadowed}")
+if eager or shadowed or importtime > args.budget:
+    sys.exit(1)
@@ -0,0 +1,72 @@
+"""
+Compares the parallel zip extraction with ZipFile.extractall
+
+Uses the given archive (for example, a windows release of lilypond) or
+creates a synthetic one resembling it: many small, compressible files
+and a few large ones
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import lilyponddist
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('archive', nargs='?', help='The zip file. If not given, a synthetic archive is created')
+parser.add_argument('--files', type=int, default=5000, help='Number of files of the synthetic archive')
+parser.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4, 8])
+parser.add_argument('--runs', type=int, default=3)
+args = parser.parse_args()
+
+tmp = Path(tempfile.mkdtemp(prefix='lilyponddist-zipextract-'))
+
+
+def synthetic(path: Path, numfiles: int) -> None:
+    rng = random.Random(0)
+    words = [bytes(rng.choices(range(97, 123), k=rng.randint(2, 10))) for _ in range(500)]
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        for i in range(numfiles):
+            size = 2**22 if i % 500 == 0 else rng.randint(200, 40000)
+            data = b' '.join(rng.choices(words, k=size // 6))
+            z.writestr(f"lilypond-2.24.1/share/lilypond/{i % 40}/{i // 40}/file{i}.scm", data)
+
+
+def bench(extract) -> float:
+    best = float('inf')
+    for _ in range(args.runs):
+        dest = tmp / 'out'
+        t0 = time.perf_counter()
+        extract(dest)
+        best = min(best, time.perf_counter() - t0)
+        shutil.rmtree(dest)
+    return best
+
+
+try:
+    if args.archive:
+        archive = Path(args.archive)
+    else:
+        archive = tmp / 'synthetic.zip'
+        synthetic(archive, args.files)
+    size = sum(info.file_size for info in zipfile.ZipFile(archive).infolist())
+    print(f"{archive.name}: {size / 2**20:.1f} MB uncompressed, {os.cpu_count()} cpus")
+
+    def extractall(dest):
+        with zipfile.ZipFile(archive) as z:
+            z.extractall(dest)
+
+    t = bench(extractall)
+    print(f"extractall:       {t:6.3f} s  {size / 2**20 / t:7.1f} MB/s")
+    for workers in args.workers:
+        t = bench(lambda dest: lilyponddist._zipextract(archive, dest, workers=workers))
+        print(f"workers={workers:<2}        {t:6.3f} s  {size / 2**20 / t:7.1f} MB/s")
+finally:
+    shutil.rmtree(tmp)